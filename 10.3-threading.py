@@ -5,6 +5,10 @@ import threading
 import time
 import logging
 import random
+import bisect
+import sqlite3
+import abc
+import weakref
 
 # The logging module supports embedding the threadname in every log message
 # Using the the formatter code %(threadName)s.
@@ -444,3 +448,280 @@ show_value(local_data)
 for i in xrange(2):
 	t = threading.Thread(name="Local Value %d" % i, target=value_worker, args=(local_data,) )
 	t.start()
+
+## 10.3.12 Sharded Counters
+# Counter takes a single Lock on every increment (and logs twice), so with many threads they queue up behind it.
+# A sharded counter gives each thread its own shard through a threading.local subclass, initialized the same way
+# as MyLocal above.  Only the owning thread ever writes to a shard, so incrementing needs no lock at all;
+# readers add the shards together, and the lock is only taken to register a new shard or to read them.
+# When a thread ends its threading.local values are freed, and a weakref callback folds its shard into a base
+# shard, so a program that keeps starting new threads doesn't keep one shard for every thread it ever ran.
+
+class ShardOwner( object ):
+	"""Held only by a thread's ThreadShard, so it goes away when that thread ends"""
+	pass
+
+class ThreadShard( threading.local ):
+	"""Holds one thread's shard of a ShardedStat, created and registered the first time that thread uses it"""
+	def __init__(self, stat):
+		self.values = stat.new_shard()
+		self.owner = ShardOwner()
+		stat.add_shard(self.owner, self.values)
+
+class ShardedStat( object ):
+	"""Base class for statistics kept in per-thread shards and merged on read, subclasses define new_shard()"""
+	__metaclass__ = abc.ABCMeta
+
+	def __init__(self):
+		# reentrant, since a shard can be folded in by a garbage collection while this thread holds the lock
+		self.lock = threading.RLock()
+		self.base = self.new_shard()
+		self.shards = {}
+		self.local = ThreadShard(self)
+	@abc.abstractmethod
+	def new_shard(self):
+		"""Returns a list of zeros, one for each value a shard keeps"""
+	def add_shard(self, owner, values):
+		with self.lock:
+			self.shards[ weakref.ref(owner, self.fold_shard) ] = values
+	def fold_shard(self, owner_ref):
+		"""Adds a finished thread's shard into the base shard and forgets it"""
+		with self.lock:
+			values = self.shards.pop(owner_ref)
+			self.base = [ total + value for total, value in zip(self.base, values) ]
+	def merged(self):
+		"""Adds up all the shards, position by position"""
+		with self.lock:
+			return [ sum(values) for values in zip(self.base, *self.shards.values()) ]
+
+class ShardedCounter( ShardedStat ):
+	def __init__(self, start=0):
+		self.start = start
+		super( ShardedCounter, self ).__init__()
+	def new_shard(self):
+		return [0]
+	def increment(self, amount=1):
+		self.local.values[0] += amount
+	@property
+	def value(self):
+		return self.start + self.merged()[0]
+
+class ShardedRate( ShardedCounter ):
+	"""A counter that also reports how fast it went up since the last time rate() was called"""
+	def __init__(self, start=0):
+		super( ShardedRate, self ).__init__(start)
+		self.last = ( start, time.time() )
+	def rate(self):
+		value, now = self.value, time.time()
+		last_value, last_time = self.last
+		self.last = ( value, now )
+		return ( value - last_value ) / ( now - last_time )
+
+class ShardedHistogram( ShardedStat ):
+	"""Counts observations into buckets, the last bucket catches everything above the highest bound"""
+	def __init__(self, bounds):
+		self.bounds = sorted(bounds)
+		super( ShardedHistogram, self ).__init__()
+	def new_shard(self):
+		return [0] * ( len(self.bounds) + 1 )
+	def observe(self, value):
+		self.local.values[ bisect.bisect_left(self.bounds, value) ] += 1
+	def counts(self):
+		return zip( self.bounds + ['inf'], self.merged() )
+
+def count_worker(counter, increments):
+	for i in xrange(increments):
+		counter.increment()
+
+def latency_worker(histogram, rate, observations):
+	for i in xrange(observations):
+		histogram.observe( random.expovariate(10) )
+		rate.increment()
+
+# Every thread records into its own shards, the main thread reads the merged results
+histogram = ShardedHistogram( [0.01, 0.05, 0.1, 0.5] )
+rate = ShardedRate()
+threads = [ threading.Thread( name="latency_worker-%s" % i, target=latency_worker, args=(histogram, rate, 10000) )
+	for i in xrange(4) ]
+[ t.start() for t in threads ]
+[ t.join() for t in threads ]
+logging.debug("Histogram: %s", histogram.counts())
+logging.debug("Observations: %d, %.0f per second", rate.value, rate.rate())
+# Threads that have ended are folded into the base shard (join() can return just before a thread's locals are
+# freed, so the last one may still be live), so starting a thread per increment doesn't grow the shards
+for i in xrange(1000):
+	t = threading.Thread( target=rate.increment )
+	t.start()
+	t.join()
+logging.debug("After 1000 more threads: %d, with %d live shards", rate.value, len(rate.shards))
+
+# Contention benchmark, Counter against ShardedCounter with the same total number of increments.
+# The logging in Counter.increment is switched off while timing, so only the locking is compared.
+total_increments = 100000
+root_logger = logging.getLogger()
+for num_threads in [1, 2, 4, 8, 16, 32, 64]:
+	timings = []
+	for counter in ( Counter(), ShardedCounter() ):
+		root_logger.setLevel(logging.INFO)
+		threads = [ threading.Thread( target=count_worker, args=(counter, total_increments // num_threads) )
+			for i in xrange(num_threads) ]
+		start = time.time()
+		[ t.start() for t in threads ]
+		[ t.join() for t in threads ]
+		timings.append( time.time() - start )
+		root_logger.setLevel(logging.DEBUG)
+	logging.debug("%2d threads: Counter %.3fs, ShardedCounter %.3fs (%d)", num_threads, timings[0], timings[1], counter.value)
+
+## 10.3.13 Resource Pools
+# ActivePool only tracks names, keeps them in a list and calls list.remove() under its lock.
+# ResourcePool hands out real, reusable resources.  Each resource lives in a numbered slot, a checkout pops a free
+# slot number off a stack and the handle pushes it back, so both are O(1) whatever the pool size.
+# It counts free slots the way the Semaphore in pool_worker does, but with a Condition so that checkout can time
+# out (Semaphore.acquire() has no timeout).  A health check runs on checkout and broken resources are replaced.
+
+class PoolTimeout( RuntimeError ):
+	pass
+
+class SlotHandle( object ):
+	"""A checked out resource and the slot it goes back into, use it in a with statement to release it"""
+	def __init__(self, pool, slot, resource):
+		self.pool = pool
+		self.slot = slot
+		self.resource = resource
+		self.released = False
+	def release(self):
+		self.pool.release(self)
+	def __enter__(self):
+		return self.resource
+	def __exit__(self, *exc_info):
+		self.release()
+
+class ResourcePool( object ):
+	def __init__(self, factory, size, health_check=None, close=None):
+		self.factory = factory
+		self.health_check = health_check
+		self.close = close
+		self.resources = [None] * size
+		self.active = [None] * size
+		self.free = range(size)
+		self.condition = threading.Condition( threading.Lock() )
+		self.checkouts = 0
+		self.timeouts = 0
+		self.replaced = 0
+		self.wait_time = 0.0
+		self.max_wait = 0.0
+
+	def checkout(self, timeout=None):
+		start = time.time()
+		with self.condition:
+			while not self.free:
+				remaining = None if timeout is None else start + timeout - time.time()
+				if remaining is not None and remaining <= 0:
+					self.timeouts += 1
+					raise PoolTimeout("No resource free after %.2fs" % timeout)
+				self.condition.wait(remaining)
+			slot = self.free.pop()
+			self.active[slot] = threading.currentThread().getName()
+			waited = time.time() - start
+			self.checkouts += 1
+			self.wait_time += waited
+			self.max_wait = max( self.max_wait, waited )
+
+		# checking and creating resources can be slow, so it's done outside the lock
+		try:
+			resource = self.resources[slot]
+			if resource is not None and self.health_check is not None and not self.health_check(resource):
+				logging.debug("Replacing resource in slot %d", slot)
+				# empty the slot first, so a factory that fails doesn't leave the broken resource in it
+				self.resources[slot] = None
+				if self.close is not None:
+					self.close(resource)
+				resource = None
+				with self.condition:
+					self.replaced += 1
+			if resource is None:
+				resource = self.resources[slot] = self.factory()
+		except:
+			self.release( SlotHandle(self, slot, None) )
+			raise
+		return SlotHandle(self, slot, self.resources[slot])
+
+	def release(self, handle):
+		with self.condition:
+			# a handle can be released explicitly and again as the with statement ends, the slot only goes back once
+			if handle.released:
+				return
+			handle.released = True
+			self.active[handle.slot] = None
+			self.free.append(handle.slot)
+			self.condition.notify()
+
+	def stats(self):
+		with self.condition:
+			return "%d checkouts, %d timeouts, %d replaced, mean wait %.2fms, max wait %.2fms" % (
+				self.checkouts, self.timeouts, self.replaced,
+				self.wait_time / self.checkouts * 1000 if self.checkouts else 0, self.max_wait * 1000 )
+
+	def __str__(self):
+		with self.condition:
+			return str( [ name for name in self.active if name is not None ] )
+
+def connect_memory_db():
+	return sqlite3.connect(':memory:', check_same_thread=False)
+
+def connection_is_open(conn):
+	try:
+		conn.execute("select 1")
+		return True
+	except sqlite3.ProgrammingError:
+		return False
+
+def resource_worker(pool):
+	try:
+		with pool.checkout(timeout=0.15) as conn:
+			logging.debug('Running: %s', pool)
+			conn.execute("select 1")
+			time.sleep(0.1)
+	except PoolTimeout, err:
+		logging.debug(err)
+
+# The pool hands out sqlite3 connections, one of which is closed behind its back to show the health check
+pool = ResourcePool( connect_memory_db, 2, health_check=connection_is_open, close=lambda conn: conn.close() )
+with pool.checkout() as conn:
+	conn.close()
+threads = [ threading.Thread( target=resource_worker, name=str(i), args=(pool, ) ) for i in xrange(6) ]
+[ t.start() for t in threads ]
+[ t.join() for t in threads ]
+logging.debug("ResourcePool: %s", pool.stats())
+
+# 1000 workers sharing 10 slots, the list-based ActivePool and Semaphore against ResourcePool.
+# Logging is switched off while timing, ActivePool logs on every change.
+def active_pool_bench_worker(s, pool, iterations):
+	name = threading.currentThread().getName()
+	for i in xrange(iterations):
+		with s:
+			pool.makeActive(name)
+			pool.makeInactive(name)
+
+def resource_pool_bench_worker(pool, iterations):
+	for i in xrange(iterations):
+		with pool.checkout():
+			pass
+
+num_workers, iterations = 1000, 20
+resource_pool = ResourcePool( object, 10 )
+benchmarks = [
+	( "ActivePool", active_pool_bench_worker, ( threading.Semaphore(10), ActivePool(), iterations ) ),
+	( "ResourcePool", resource_pool_bench_worker, ( resource_pool, iterations ) ),
+]
+root_logger = logging.getLogger()
+for name, target, args in benchmarks:
+	root_logger.setLevel(logging.INFO)
+	threads = [ threading.Thread( target=target, args=args ) for i in xrange(num_workers) ]
+	start = time.time()
+	[ t.start() for t in threads ]
+	[ t.join() for t in threads ]
+	elapsed = time.time() - start
+	root_logger.setLevel(logging.DEBUG)
+	logging.debug("%-12s %d workers x %d checkouts: %.3fs", name, num_workers, iterations, elapsed)
+logging.debug("ResourcePool: %s", resource_pool.stats())
@@ -12,6 +12,15 @@ import itertools
 import operator
 import glob
 import string
+import os
+import shutil
+import mmap
+import array
+import math
+import re
+import tempfile
+import resource
+import cPickle
 
 # Set up logging
 import logging
@@ -39,7 +48,12 @@ chapter_sections = [ {},
     {},{},{},{},
     {'start':"starting",},
     {},{},{},{},{},{},{},
+    {},{},{},{},{},{},
 ]
+STOP_WORDS = set([ 'an', 'and', 'are', 'as', 'be', 'by', 'for', 'if', 'in', 'is', 'it', 'of', 'or', 'py',
+                   'that', 'the', 'to', 'with', ])
+# Per-process state loaded by pool initializers, see MapReducePool
+worker_state = {}
 
 ## Functions
 def worker( i=0 ):
@@ -136,6 +150,17 @@ def pool_worker(s, pool):
         time.sleep( random.random() )
         pool.makeInactive( name )
 
+def slot_pool_worker(pool):
+    logger = logging.getLogger("slot_pool_worker")
+    name = multiprocessing.current_process().name
+    start = time.time()
+    slot = pool.checkout( name, timeout=5 )
+    try:
+        logger.info( "Slot %d after %.2fs, now running: %s", slot, time.time() - start, str(pool) )
+        time.sleep( random.random() )
+    finally:
+        pool.release( slot )
+
 def key_worker(d, key, value):
     d[key] = value
 
@@ -162,12 +187,18 @@ def start_process():
 def do_calculation(data):
     return data * 2
 
+def calculation_to_pairs( data ):
+    """Map function for do_calculation, keyed on the last digit of the input."""
+    return [ ( data % 10, do_calculation(data) ) ]
+
+def make_array( size ):
+    """Return an array of doubles taking up size bytes, standing in for a large numeric result."""
+    return array.array( 'd', [ float(size) ] ) * ( size // 8 )
+
 
 def file_to_words( filename ):
     """Read a file and return a sequence of (word, occurrence) values."""
     logger = logging.getLogger("file_to_words")
-    STOP_WORDS = set([ 'an', 'and', 'are', 'as', 'be', 'by', 'for', 'if', 'in', 'is', 'it', 'of', 'or', 'py',
-                       'that', 'the', 'to', 'with', ])
     TR = string.maketrans( string.punctuation, " " * len(string.punctuation))
 
     logger.info( "%s reading %s", multiprocessing.current_process().name, filename)
@@ -191,6 +222,56 @@ def count_words( item ):
     word, occurrences = item
     return ( word, sum(occurrences) )
 
+def setup_worker( initializer=None, initargs=(), max_rss=None, recycle=None ):
+    """Pool initializer for MapReducePool.
+    Keeps the memory limit and recycle flag where MemoryCheckedCall can find them, then runs the caller's initializer."""
+    worker_state['max_rss'] = max_rss
+    worker_state['recycle'] = recycle
+    if initializer is not None:
+        initializer( *initargs )
+
+def load_word_tables():
+    """Initializer that builds the tables used by warm_file_to_words once per worker instead of once per file."""
+    start_process()
+    worker_state['translate'] = string.maketrans( string.punctuation, " " * len(string.punctuation))
+    worker_state['comment'] = re.compile( r'^\s*#' )
+    worker_state['word'] = re.compile( r'^[a-z]{2,}$' )
+
+def warm_file_to_words( filename ):
+    """file_to_words, using the tables loaded by load_word_tables."""
+    translate = worker_state['translate']
+    comment = worker_state['comment']
+    word_match = worker_state['word'].match
+    output = []
+    with open(filename, mode='r') as f:
+        for line in f:
+            if comment.match(line):
+                continue
+            for word in line.translate(translate).lower().split():
+                if word_match(word) and word not in STOP_WORDS:
+                    output.append( (word, 1) )
+    return output
+
+def current_rss():
+    """Return the resident set size of this process in KB, or the peak size where /proc isn't available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int( f.read().split()[1] ) * resource.getpagesize() // 1024
+    except IOError:
+        return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+
+def measure_map_reduce( queue, name, mapper_class, inputs, kwargs ):
+    """Run one MapReduce job and report the wall time and the peak RSS of the parent process.
+    Meant to be the target of a fresh Process so that ru_maxrss only covers this one job."""
+    start = time.time()
+    mapper = mapper_class( file_to_words, count_words, **kwargs )
+    word_counts = mapper( inputs )
+    elapsed = time.time() - start
+    mapper.pool.close()
+    mapper.pool.join()
+    # ru_maxrss is reported in kilobytes on Linux
+    queue.put( (name, elapsed, resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss, len(word_counts)) )
+
 
 ## Classes
 class Worker( multiprocessing.Process ):
@@ -260,9 +341,32 @@ class ActivePool( object ):
         with self.lock:
             return str( self.active )
 
+class SlotPool( object ):
+    """Tracks active processes in numbered slots.
+    A Queue of free slot numbers replaces the Semaphore, and each process writes its name into its own slot,
+    so nothing has to search a list.  The slot number can also index a per-slot resource, such as a port."""
+    logger = logging.getLogger("SlotPool")
+    def __init__(self, size):
+        super( SlotPool, self ).__init__()
+        self.mgr = multiprocessing.Manager()
+        self.active = self.mgr.list( [None] * size )
+        self.free = multiprocessing.Queue()
+        for slot in xrange(size):
+            self.free.put(slot)
+    def checkout(self, name, timeout=None):
+        """Wait for a free slot and return its number, raises Queue.Empty if timeout runs out first."""
+        slot = self.free.get( timeout=timeout )
+        self.active[slot] = name
+        return slot
+    def release(self, slot):
+        self.active[slot] = None
+        self.free.put(slot)
+    def __str__(self):
+        return str( [ name for name in self.active if name is not None ] )
+
 class SimpleMapReduce( object ):
     logger = logging.getLogger("SimpleMapReduce")
-    def __init__( self, map_func, reduce_func, num_workers=None):
+    def __init__( self, map_func, reduce_func, num_workers=None, pool=None):
         """
         map_func
         Function to map inputs to intermediate data.
@@ -275,11 +379,16 @@ class SimpleMapReduce( object ):
         num_workers
         The number of workers to create in the pool.
         Defaults to the number of CPUs available on the current host.
+
+        pool
+        An existing Pool to run in instead of creating a new one, see MapReducePool.
         """
 
         self.map_func = map_func
         self.reduce_func = reduce_func
-        self.pool = multiprocessing.Pool(num_workers)
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.pool = pool or multiprocessing.Pool(num_workers)
+        self.stats = ChunksizeStats()
 
     def partition(self, mapped_values):
         """Organize the mapped values by their key.
@@ -290,7 +399,47 @@ class SimpleMapReduce( object ):
             partitioned_data[key].append(value)
         return partitioned_data.items()
 
-    def __call__( self, inputs, chunksize=1):
+    def tune_chunksize(self, inputs, target_overhead, sample_size=None):
+        """Time a sample of the inputs one task at a time and pick a chunksize that keeps the IPC overhead
+        under target_overhead (a fraction of the total time).
+        Returns the chunksize and the map results for the sample, so the sampled work isn't repeated.
+        """
+        sample_size = sample_size or self.num_workers * 16
+        sample = inputs[:sample_size]
+        start = time.time()
+        timed_responses = self.pool.map( TimedCall( self.map_func ), sample, chunksize=1 )
+        elapsed = time.time() - start
+
+        # Each worker handled about len(sample) / num_workers tasks in the elapsed time.
+        # Whatever wasn't spent in map_func went to pickling, the pipes and the pool's bookkeeping.
+        task_cost = sum( cost for cost, response in timed_responses ) / len(sample)
+        task_overhead = max( 0.0, elapsed * min( self.num_workers, len(sample) ) / len(sample) - task_cost )
+        if task_cost > 0:
+            chunksize = int( math.ceil( task_overhead * (1 - target_overhead) / (target_overhead * task_cost) ) )
+        else:
+            chunksize = len(inputs)
+        # Keep a few chunks per worker so a slow chunk at the end doesn't leave the others idle
+        chunksize = max( 1, min( chunksize, (len(inputs) - len(sample)) // (self.num_workers * 4) ) )
+
+        self.stats.update( chunksize, len(sample), task_cost, task_overhead, target_overhead )
+        self.logger.debug( "Tuned %s", self.stats )
+        return chunksize, [ response for cost, response in timed_responses ]
+
+    def resolve_chunksize(self, inputs, chunksize, target_overhead):
+        """Works out the chunksize to map with, tuning it when it's 'auto'.
+        Returns the inputs still to be mapped, the chunksize, and the map results for the inputs tuning already ran.
+        """
+        if chunksize != 'auto':
+            self.stats.update( chunksize )
+            return inputs, chunksize, []
+        inputs = list(inputs)
+        if not inputs:
+            self.stats.update( 1 )
+            return inputs, 1, []
+        chunksize, map_responses = self.tune_chunksize( inputs, target_overhead )
+        return inputs[len(map_responses):], chunksize, map_responses
+
+    def __call__( self, inputs, chunksize=1, target_overhead=0.05):
         """ Process the inputs through the map and reduce functions given.
 
         inputs
@@ -299,13 +448,338 @@ class SimpleMapReduce( object ):
         chunksize
         The portion of the input data to hand to each worker.
         This can be used to turn performance during the mapping phase.
+        Pass 'auto' to have it picked from a timed sample of the inputs, see tune_chunksize() and self.stats.
+
+        target_overhead
+        The fraction of the mapping time that may go to IPC when chunksize is 'auto'.
         """
-        print inputs
-        map_responses = self.pool.map( self.map_func, inputs, chunksize=chunksize)
+        inputs, chunksize, map_responses = self.resolve_chunksize( inputs, chunksize, target_overhead )
+        map_responses.extend( self.pool.map( self.map_func, inputs, chunksize=chunksize ) )
         partitioned_data = self.partition( itertools.chain( *map_responses ) )
         reduced_values = self.pool.map( self.reduce_func, partitioned_data )
         return reduced_values
 
+class ChunksizeStats( object ):
+    """What SimpleMapReduce measured and chose for its last call.  Times are in seconds per task."""
+    def __init__(self):
+        self.update( None )
+
+    def update(self, chunksize, sample_size=0, task_cost=None, task_overhead=None, target_overhead=None):
+        self.chunksize = chunksize
+        self.sample_size = sample_size
+        self.task_cost = task_cost
+        self.task_overhead = task_overhead
+        self.target_overhead = target_overhead
+
+    def __str__(self):
+        if not self.sample_size:
+            return "chunksize=%s (fixed)" % self.chunksize
+        return "chunksize=%s (sampled %d tasks: %.1fus work, %.1fus overhead each, target %.0f%% overhead)" % (
+            self.chunksize, self.sample_size, self.task_cost * 1e6, self.task_overhead * 1e6, self.target_overhead * 100 )
+
+class TimedCall( object ):
+    """Runs func in a worker and returns how long it took along with the result."""
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, item):
+        start = time.time()
+        result = self.func( item )
+        return time.time() - start, result
+
+class MemoryCheckedCall( object ):
+    """Runs func in a MapReducePool worker and asks for the pool to be recycled once the worker grows past max_rss."""
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, item):
+        result = self.func( item )
+        max_rss = worker_state.get('max_rss')
+        if max_rss is not None and current_rss() > max_rss:
+            worker_state['recycle'].value = 1
+        return result
+
+class MapReducePool( object ):
+    logger = logging.getLogger("MapReducePool")
+    def __init__( self, num_workers=None, initializer=None, initargs=(), max_rss=None ):
+        """A long-lived pool for running many MapReduce jobs back to back.
+
+        num_workers
+        The number of workers to create in the pool.
+        Defaults to the number of CPUs available on the current host.
+
+        initializer, initargs
+        Called once in each worker as it starts, to load state (compiled regexes, lookup tables) that every job uses.
+
+        max_rss
+        The resident size in KB above which the workers are replaced with fresh ones.
+        Checked after every task and acted on between jobs, so a job is never interrupted.
+        Defaults to None, which never recycles.
+        """
+        self.num_workers = num_workers
+        self.initializer = initializer
+        self.initargs = initargs
+        self.max_rss = max_rss
+        self.recycle = multiprocessing.Value( 'b', 0 )
+        self.jobs = 0
+        self.recycled = 0
+        self.pool = self.start_pool()
+
+    def start_pool(self):
+        return multiprocessing.Pool( self.num_workers, initializer=setup_worker,
+                                     initargs=( self.initializer, self.initargs, self.max_rss, self.recycle ) )
+
+    def run( self, map_func, reduce_func, inputs, chunksize=1 ):
+        """Process the inputs through the map and reduce functions given, the same way SimpleMapReduce does."""
+        mapper = SimpleMapReduce( MemoryCheckedCall( map_func ), MemoryCheckedCall( reduce_func ),
+                                  self.num_workers, pool=self.pool )
+        reduced_values = mapper( inputs, chunksize=chunksize )
+        self.jobs += 1
+        if self.recycle.value:
+            self.logger.info( "A worker grew past %d KB during job %d, recycling the pool", self.max_rss, self.jobs )
+            self.close()
+            self.pool = self.start_pool()
+            self.recycle.value = 0
+            self.recycled += 1
+        return reduced_values
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+class MapCombiner( object ):
+    """Wraps a map function so each worker combines its own output before handing it back to the parent.
+    Defined at module level so the pool can pickle it."""
+    def __init__(self, map_func, combine_func):
+        self.map_func = map_func
+        self.combine_func = combine_func
+
+    def __call__(self, item):
+        partitioned_data = collections.defaultdict( list )
+        for key, value in self.map_func( item ):
+            partitioned_data[key].append(value)
+        return [ self.combine_func( group ) for group in partitioned_data.iteritems() ]
+
+class ShuffleMapper( object ):
+    """Runs the map function for one input and hashes its output straight into the reducer partition files,
+    so the parent never sees the intermediate values.
+    Each process appends to its own file for each partition, so there are num_partitions files per worker
+    however many inputs there are, and no two processes ever write to the same file."""
+    def __init__(self, map_func, num_partitions, shuffle_dir):
+        self.map_func = map_func
+        self.num_partitions = num_partitions
+        self.shuffle_dir = shuffle_dir
+
+    def __call__(self, task):
+        task_id, item = task
+        return self.write( task_id, self.map_func( item ) )
+
+    def write(self, task_id, mapped_values):
+        partitions = [ [] for i in xrange(self.num_partitions) ]
+        for key, value in mapped_values:
+            partitions[ hash(key) % self.num_partitions ].append( (key, value) )
+        for partition, pairs in enumerate(partitions):
+            if pairs:
+                # one pickle per task, appended after the ones this worker wrote before
+                filename = os.path.join( self.shuffle_dir, "part-%04d-worker-%d" % (partition, os.getpid()) )
+                with open( filename, 'ab' ) as f:
+                    cPickle.dump( pairs, f, cPickle.HIGHEST_PROTOCOL )
+        return task_id
+
+class ShuffleReducer( object ):
+    """Groups and reduces every key in one partition, reading every pickle in each of the files the workers wrote for it."""
+    def __init__(self, reduce_func, shuffle_dir):
+        self.reduce_func = reduce_func
+        self.shuffle_dir = shuffle_dir
+
+    def __call__(self, partition):
+        partitioned_data = collections.defaultdict( list )
+        for filename in glob.glob( os.path.join( self.shuffle_dir, "part-%04d-worker-*" % partition ) ):
+            with open( filename, 'rb' ) as f:
+                while True:
+                    try:
+                        pairs = cPickle.load( f )
+                    except EOFError:
+                        break
+                    for key, value in pairs:
+                        partitioned_data[key].append(value)
+        return [ self.reduce_func( item ) for item in partitioned_data.iteritems() ]
+
+class ShuffleMapReduce( SimpleMapReduce ):
+    logger = logging.getLogger("ShuffleMapReduce")
+    def __init__( self, map_func, reduce_func, num_workers=None, num_partitions=None, shuffle_dir=None ):
+        """
+        num_partitions
+        The number of reducer partitions the mappers hash their keys into.
+        Defaults to the number of workers, or the number of CPUs available on the current host.
+
+        shuffle_dir
+        Where to create the temporary directory holding the partition files.  Defaults to the tempfile default.
+        """
+        super( ShuffleMapReduce, self ).__init__( map_func, reduce_func, num_workers )
+        self.num_partitions = num_partitions or num_workers or multiprocessing.cpu_count()
+        self.shuffle_dir = shuffle_dir
+
+    def __call__( self, inputs, chunksize=1, target_overhead=0.05):
+        """ Process the inputs through the map and reduce functions given.
+        The mappers partition their own output, so the parent only hands out work:
+        each partition is reduced by a separate task and none of the keys pass through this process.
+        """
+        shuffle_dir = tempfile.mkdtemp( prefix="shuffle-", dir=self.shuffle_dir )
+        try:
+            mapper = ShuffleMapper( self.map_func, self.num_partitions, shuffle_dir )
+            inputs, chunksize, map_responses = self.resolve_chunksize( inputs, chunksize, target_overhead )
+            # the inputs mapped while tuning came back here, so they're partitioned here
+            for task_id, mapped_values in enumerate(map_responses):
+                mapper.write( task_id, mapped_values )
+            for task_id in self.pool.imap_unordered( mapper, enumerate( inputs, len(map_responses) ), chunksize=chunksize ):
+                pass
+            reducer = ShuffleReducer( self.reduce_func, shuffle_dir )
+            pending = [ self.pool.apply_async( reducer, (partition,) ) for partition in xrange(self.num_partitions) ]
+            reduced_values = []
+            for result in pending:
+                reduced_values.extend( result.get() )
+        finally:
+            shutil.rmtree( shuffle_dir, ignore_errors=True )
+        return reduced_values
+
+class SharedResultTransport( object ):
+    """Hands results back from the pool workers through an anonymous shared mmap instead of the result pipe.
+    Each task writes its array into its own slot and only (offset, length, typecode) is pickled back.
+    Must be created before the Pool, so the forked workers inherit the mapping and the registry entry."""
+    logger = logging.getLogger("SharedResultTransport")
+    registry = {}
+
+    def __init__(self, num_slots, slot_size, typecode='d'):
+        self.num_slots = num_slots
+        self.slot_size = slot_size
+        self.typecode = typecode
+        self.key = id(self)
+        self.buffer = mmap.mmap( -1, num_slots * slot_size )
+        SharedResultTransport.registry[self.key] = self
+
+    def write(self, slot, values):
+        """Store one result in its slot and return where to find it."""
+        if slot >= self.num_slots:
+            raise IndexError("slot %d out of range, transport has %d slots" % (slot, self.num_slots))
+        if not isinstance( values, array.array ):
+            values = array.array( self.typecode, values )
+        data = values.tostring()
+        if len(data) > self.slot_size:
+            raise ValueError("result of %d bytes does not fit in a %d byte slot" % (len(data), self.slot_size))
+        offset = slot * self.slot_size
+        self.buffer[offset:offset + len(data)] = data
+        return ( offset, len(data), values.typecode )
+
+    def read(self, location):
+        """Copy a result written by a worker out of the shared buffer."""
+        offset, length, typecode = location
+        values = array.array( typecode )
+        values.fromstring( self.buffer[offset:offset + length] )
+        return values
+
+    def map(self, pool, func, inputs, chunksize=1):
+        """Like pool.map(), but the results come back through the shared buffer."""
+        locations = pool.map( SharedResultWriter( self.key, func ), enumerate(inputs), chunksize=chunksize )
+        return [ self.read(location) for location in locations ]
+
+    def close(self):
+        del SharedResultTransport.registry[self.key]
+        self.buffer.close()
+
+class SharedResultWriter( object ):
+    """Runs func in a worker and writes the result through the transport.
+    Only the registry key is pickled, the mmap itself can't be."""
+    def __init__(self, key, func):
+        self.key = key
+        self.func = func
+
+    def __call__(self, task):
+        slot, item = task
+        return SharedResultTransport.registry[self.key].write( slot, self.func( item ) )
+
+class StreamingMapReduce( SimpleMapReduce ):
+    logger = logging.getLogger("StreamingMapReduce")
+    def __init__( self, map_func, reduce_func, num_workers=None, combine_func=None, buffer_size=100000,
+                  spill_partitions=16, spill_dir=None ):
+        """
+        combine_func
+        Optional function used to pre-aggregate values for a key, in the workers and before spilling.
+        Takes the same (key, values) tuple as reduce_func and returns a (key, value) tuple,
+        so reduce_func has to accept its own partial results (count_words does).
+
+        buffer_size
+        The number of intermediate values held in the parent before they are spilled to disk.
+
+        spill_partitions
+        The number of temporary files the spilled keys are hashed into.
+        Each one is reduced separately, so only one of them is in memory at a time.
+
+        spill_dir
+        Where to create the temporary files.  Defaults to the tempfile default.
+        """
+        super( StreamingMapReduce, self ).__init__( map_func, reduce_func, num_workers )
+        self.combine_func = combine_func
+        self.buffer_size = buffer_size
+        self.spill_partitions = spill_partitions
+        self.spill_dir = spill_dir
+
+    def spill(self, partitioned_data, spill_files):
+        """Write the buffered values to the spill file for each key and empty the buffer."""
+        for key, values in partitioned_data.iteritems():
+            if self.combine_func is not None:
+                values = [ self.combine_func( (key, values) )[1] ]
+            spill_file = spill_files[ hash(key) % len(spill_files) ]
+            cPickle.dump( (key, values), spill_file, cPickle.HIGHEST_PROTOCOL )
+        partitioned_data.clear()
+
+    def read_spill(self, spill_file):
+        """Load one spill file back into a sequence of tuples with a key and sequence of values."""
+        spill_file.seek(0)
+        partitioned_data = collections.defaultdict( list )
+        while True:
+            try:
+                key, values = cPickle.load( spill_file )
+            except EOFError:
+                break
+            partitioned_data[key].extend(values)
+        return partitioned_data.items()
+
+    def __call__( self, inputs, chunksize=1, target_overhead=0.05):
+        """ Process the inputs through the map and reduce functions given.
+        Mapped values are partitioned as each worker finishes instead of after the whole map phase,
+        and are spilled to disk whenever more than buffer_size of them are held in memory.
+        """
+        map_func = self.map_func
+        if self.combine_func is not None:
+            map_func = MapCombiner( self.map_func, self.combine_func )
+
+        partitioned_data = collections.defaultdict( list )
+        spill_files = []
+        buffered = 0
+        # the inputs mapped while tuning weren't combined, which is fine as reduce_func takes uncombined values too
+        inputs, chunksize, map_responses = self.resolve_chunksize( inputs, chunksize, target_overhead )
+        for mapped_values in itertools.chain( map_responses, self.pool.imap_unordered( map_func, inputs, chunksize=chunksize ) ):
+            for key, value in mapped_values:
+                partitioned_data[key].append(value)
+            buffered += len(mapped_values)
+            if buffered > self.buffer_size:
+                if not spill_files:
+                    spill_files = [ tempfile.TemporaryFile( dir=self.spill_dir ) for i in xrange(self.spill_partitions) ]
+                self.logger.debug( "Spilling %d values to %d files", buffered, len(spill_files) )
+                self.spill( partitioned_data, spill_files )
+                buffered = 0
+
+        if not spill_files:
+            return self.pool.map( self.reduce_func, partitioned_data.items() )
+
+        self.spill( partitioned_data, spill_files )
+        reduced_values = []
+        for spill_file in spill_files:
+            reduced_values.extend( self.pool.map( self.reduce_func, self.read_spill( spill_file ) ) )
+            spill_file.close()
+        return reduced_values
+
 ## Runtime Configuration
 if results.section in xrange( 0, len(chapter_sections) ):
     logger = logging.getLogger("10.4 multiprocessing - Manage Processes like Threads")
@@ -689,6 +1163,175 @@ if results.section in xrange( 0, len(chapter_sections) ):
             print '%-*s: %5s' % (longest+1, word, count)
         print
 
+    if results.section == 19 or results.section == 0:
+        logger = logging.getLogger("10.4.19 Streaming MapReduce")
+        # SimpleMapReduce waits for every mapper with pool.map() and then holds every (word, 1) pair in the parent
+        # while partitioning, so memory grows with the size of the input rather than the number of distinct words.
+        # StreamingMapReduce consumes the results with imap_unordered() as they arrive, lets each worker combine its
+        # own output first (count_words doubles as the combiner, because a sum of sums is still a sum), and spills
+        # the partitions to temporary files whenever the buffer grows past buffer_size.
+        input_files = glob.glob('*.py') * 20
+
+        mapper = StreamingMapReduce( file_to_words, count_words, combine_func=count_words, buffer_size=10000 )
+        word_counts = mapper(input_files)
+        word_counts.sort( key=operator.itemgetter(1), reverse=True )
+        logger.info("Top 5 words: %s", word_counts[:5])
+
+        # Each implementation runs in its own process, so that ru_maxrss is the peak for that job alone.
+        queue = multiprocessing.Queue()
+        runs = [ ( "SimpleMapReduce", SimpleMapReduce, {} ),
+                 ( "StreamingMapReduce", StreamingMapReduce, {'combine_func':count_words,} ),
+                 ( "StreamingMapReduce, spilling", StreamingMapReduce, {'combine_func':count_words, 'buffer_size':1000,} ),
+        ]
+        logging.getLogger("file_to_words").setLevel(logging.WARNING)
+        for name, mapper_class, kwargs in runs:
+            p = multiprocessing.Process( target=measure_map_reduce, args=(queue, name, mapper_class, input_files, kwargs) )
+            p.start()
+            name, elapsed, max_rss, num_words = queue.get()
+            p.join()
+            logger.info("%-30s %6.2fs  peak RSS %7d KB  %d words", name, elapsed, max_rss, num_words)
+
+    if results.section == 20 or results.section == 0:
+        logger = logging.getLogger("10.4.20 Shuffling MapReduce")
+        # In SimpleMapReduce every (word, 1) pair is pickled back to the parent, which groups them on its own before
+        # the reduce phase can start.  With more workers the parent becomes the bottleneck.
+        # ShuffleMapReduce has each mapper hash its keys into num_partitions files, one per reducer, so the
+        # shuffle happens in the workers.  Each reducer then reads only its own partition and the parent just
+        # concatenates the reduced values.
+        input_files = glob.glob('*.py')
+        logging.getLogger("file_to_words").setLevel(logging.WARNING)
+
+        simple = SimpleMapReduce( file_to_words, count_words )
+        shuffle = ShuffleMapReduce( file_to_words, count_words )
+        expected = sorted( simple( input_files ) )
+        shuffled = sorted( shuffle( input_files ) )
+        logger.info("Same word counts as SimpleMapReduce: %s", shuffled == expected)
+        for mapper in ( simple, shuffle ):
+            mapper.pool.close()
+            mapper.pool.join()
+
+        # How the two scale with the number of workers.  Timing includes starting the pool.
+        input_files = input_files * 20
+        for num_workers in sorted( set( [ 1, 2, 4, multiprocessing.cpu_count() ] ) ):
+            for mapper_class in ( SimpleMapReduce, ShuffleMapReduce ):
+                start = time.time()
+                mapper = mapper_class( file_to_words, count_words, num_workers=num_workers )
+                mapper(input_files)
+                mapper.pool.close()
+                mapper.pool.join()
+                logger.info("%-18s %2d workers: %6.2fs", mapper_class.__name__, num_workers, time.time() - start)
+
+    if results.section == 21 or results.section == 0:
+        logger = logging.getLogger("10.4.21 Shared Memory Results")
+        # Every value returned by a Pool worker is pickled, written to the result pipe, read by the parent's result
+        # handler thread and unpickled again.  For large numeric arrays that copying dominates the run time.
+        # SharedResultTransport sets aside one slot per task in an anonymous mmap that the workers inherit when the
+        # pool forks, so the worker writes the raw bytes once and the pipe only carries the offset.
+        inputs = list( xrange(10) )
+        transport = SharedResultTransport( len(inputs), 8 * 10 )
+        pool = multiprocessing.Pool()
+        outputs = transport.map( pool, make_array, [ 8 * i for i in inputs ] )
+        pool.close()
+        pool.join()
+        transport.close()
+        logger.info("Shared: %s", [ a.tolist() for a in outputs ])
+
+        # Throughput for results from 1 KB to 100 MB, keeping about 200 MB of results per run
+        for size in [ 2**10, 2**14, 2**17, 2**20, 2**23, 100 * 2**20 ]:
+            sizes = [ size ] * max( 2, min( 1000, (200 * 2**20) // size ) )
+            total_mb = float( size * len(sizes) ) / 2**20
+
+            pool = multiprocessing.Pool()
+            start = time.time()
+            pool.map( make_array, sizes )
+            pickled = time.time() - start
+            pool.close()
+            pool.join()
+
+            transport = SharedResultTransport( len(sizes), size )
+            pool = multiprocessing.Pool()
+            start = time.time()
+            transport.map( pool, make_array, sizes )
+            shared = time.time() - start
+            pool.close()
+            pool.join()
+            transport.close()
+
+            logger.info("%9d bytes x %4d: pool.map %8.1f MB/s   shared %8.1f MB/s",
+                        size, len(sizes), total_mb / pickled, total_mb / shared)
+
+    if results.section == 22 or results.section == 0:
+        logger = logging.getLogger("10.4.22 Tuning the Chunksize")
+        # With the default chunksize of 1 every input makes its own round trip through the task and result queues.
+        # That's fine for reading a file, but do_calculation takes a microsecond, so almost all of the time goes to
+        # IPC.  Passing chunksize='auto' times a sample of the inputs first and picks a chunksize that keeps the
+        # overhead under target_overhead.  What it measured and chose is kept in the mapper's stats.
+        inputs = list( xrange(20000) )
+        for chunksize in ( 1, 'auto' ):
+            mapper = SimpleMapReduce( calculation_to_pairs, count_words )
+            start = time.time()
+            totals = sorted( mapper( inputs, chunksize=chunksize ) )
+            logger.info("%6.2fs %s", time.time() - start, mapper.stats)
+            mapper.pool.close()
+            mapper.pool.join()
+        logger.info("Totals by last digit: %s", totals)
+
+    if results.section == 23 or results.section == 0:
+        logger = logging.getLogger("10.4.23 Persistent Pools")
+        # Every SimpleMapReduce builds its own Pool, so every job pays for forking the workers and running their
+        # initializer, and section 17 makes it worse by restarting the workers every two tasks.
+        # MapReducePool keeps one pool for many jobs.  State loaded by the initializer (here load_word_tables)
+        # stays warm in the workers, and they are only replaced when one of them grows past max_rss.
+        input_files = glob.glob('*.py')[:4]
+        num_jobs = 10
+        logging.getLogger("file_to_words").setLevel(logging.WARNING)
+        logging.getLogger("start_process()").setLevel(logging.WARNING)
+
+        start = time.time()
+        for i in xrange(num_jobs):
+            mapper = SimpleMapReduce( file_to_words, count_words )
+            expected = sorted( mapper(input_files) )
+            mapper.pool.close()
+            mapper.pool.join()
+        logger.info("New pool per job           : %6.1fms per job", (time.time() - start) * 1000 / num_jobs)
+
+        start = time.time()
+        for i in xrange(num_jobs):
+            pool = multiprocessing.Pool( initializer=start_process, maxtasksperchild=2 )
+            mapper = SimpleMapReduce( file_to_words, count_words, pool=pool )
+            mapper(input_files)
+            pool.close()
+            pool.join()
+        logger.info("New pool, maxtasksperchild: %6.1fms per job", (time.time() - start) * 1000 / num_jobs)
+
+        word_pool = MapReducePool( initializer=load_word_tables )
+        start = time.time()
+        for i in xrange(num_jobs):
+            word_counts = sorted( word_pool.run( warm_file_to_words, count_words, input_files ) )
+        logger.info("MapReducePool              : %6.1fms per job", (time.time() - start) * 1000 / num_jobs)
+        word_pool.close()
+        logger.info("Same word counts: %s", word_counts == expected)
+
+        # A limit below what a worker needs just to exist recycles the pool after every job
+        word_pool = MapReducePool( initializer=load_word_tables, max_rss=current_rss() // 2 )
+        for i in xrange(3):
+            word_pool.run( warm_file_to_words, count_words, input_files )
+        logger.info("Recycled the pool %d times in %d jobs", word_pool.recycled, word_pool.jobs)
+        word_pool.close()
+
+    if results.section == 24 or results.section == 0:
+        logger = logging.getLogger("10.4.24 Slot Pools")
+        # The same job as section 14 with a SlotPool.  Checking out a slot takes the place of the Semaphore, and
+        # the slot number says where the process's name goes, so releasing it doesn't need list.remove().
+        pool = SlotPool(3)
+        jobs = [ multiprocessing.Process( target=slot_pool_worker, name="PW %d" % i, args=( pool, ) ) for i in xrange(10)]
+
+        for j in jobs:
+            j.start()
+        for j in jobs:
+            j.join()
+            logger.info("Now running: %s", str(pool))
+
 else:
     # If the command isn't recognized because it wasn't given, show the help.
     if not results.section:
@@ -6,6 +6,13 @@
 import xmlrpclib
 import datetime
 import pprint
+import os
+import time
+import socket
+import errno
+import httplib
+import threading
+from xmlrpclib_framing import FRAMED_CONTENT_TYPE, FRAME_MAGIC, frame_message, loads_framed
 try:
     import cPickle as pickle
 except:
@@ -30,7 +37,147 @@ class MyObj( object ):
     def __repr__(self):
         return "MyObj(%s, %s)" % ( repr(self.a), repr(self.b) )
         
+class FramedTransport( xmlrpclib.Transport ):
+    """Transport that asks for framed responses, and once the server has sent one, frames its requests too.
+    ServerProxy marshals every call as plain XML-RPC, so framing a request turns its base64 values back into raw bytes;
+    the message on the wire and the server's work are smaller, the client still pays for the base64 it started with."""
+    server_frames = False
+
+    def request( self, host, handler, request_body, verbose=0 ):
+        if self.server_frames:
+            request_body = frame_message( request_body )
+        return xmlrpclib.Transport.request( self, host, handler, request_body, verbose )
+
+    def send_content( self, connection, request_body ):
+        connection.putheader( "Accept", "%s, text/xml" % FRAMED_CONTENT_TYPE )
+        if not request_body.startswith( FRAME_MAGIC ):
+            return xmlrpclib.Transport.send_content( self, connection, request_body )
+        connection.putheader( "Content-Type", FRAMED_CONTENT_TYPE )
+        # compressed the same way Transport.send_content() compresses plain requests
+        if self.encode_threshold is not None and self.encode_threshold < len(request_body):
+            connection.putheader( "Content-Encoding", "gzip" )
+            request_body = xmlrpclib.gzip_encode( request_body )
+        connection.putheader( "Content-Length", str(len(request_body)) )
+        connection.endheaders( request_body )
+
+    def parse_response( self, response ):
+        if response.getheader( "content-type", "" ) != FRAMED_CONTENT_TYPE:
+            return xmlrpclib.Transport.parse_response( self, response )
+        self.server_frames = True
+        if response.getheader( "content-encoding", "" ) == "gzip":
+            stream = xmlrpclib.GzipDecodedResponse( response )
+            data = stream.read()
+            stream.close()
+        else:
+            data = response.read()
+        return loads_framed( data, self._use_datetime )[0]
+
+class PooledTransport( xmlrpclib.Transport ):
+    """Transport that keeps a pool of open HTTP/1.1 connections for each host, shared by every thread and ServerProxy using it.
+    A call takes an idle connection from the pool, or opens a new one, and puts it back afterwards.
+    At most pool_size idle connections are kept per host, and any left idle for more than idle_timeout seconds are closed.
+    With gzip=True, requests over encode_threshold bytes are compressed, and compressed responses are accepted."""
+
+    def __init__( self, pool_size=10, idle_timeout=30.0, gzip=False, use_datetime=0 ):
+        xmlrpclib.Transport.__init__( self, use_datetime )
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.accept_gzip_encoding = gzip
+        if gzip:
+            self.encode_threshold = 1400
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.connections_opened = 0
+
+    def checkout( self, host ):
+        """Returns an idle connection to host and the extra headers (such as Authorization) to send on it,
+        or a new connection if there are none idle."""
+        now = time.time()
+        with self.lock:
+            idle = self.idle.setdefault( host, [] )
+            while idle:
+                connection, extra_headers, last_used = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    return connection, extra_headers
+                connection.close()
+            self.connections_opened += 1
+        # Transport keeps these in self._extra_headers, which every thread using the pool would share
+        chost, extra_headers, x509 = self.get_host_info( host )
+        return httplib.HTTPConnection( chost ), extra_headers
+
+    def checkin( self, host, connection, extra_headers ):
+        with self.lock:
+            idle = self.idle.setdefault( host, [] )
+            if len(idle) < self.pool_size:
+                idle.append( ( connection, extra_headers, time.time() ) )
+                return
+        connection.close()
+
+    def request( self, host, handler, request_body, verbose=0 ):
+        # An idle connection may have been closed by the server.  As in Transport.request(), a call is only tried again,
+        # on a new connection, when the old one was reset or gave no response at all, so the server can't have run it.
+        for attempt in ( 0, 1 ):
+            connection, extra_headers = self.checkout( host )
+            reused = connection.sock is not None
+            try:
+                result = self.single_request_on( connection, extra_headers, host, handler, request_body, verbose )
+            except xmlrpclib.Fault:
+                self.checkin( host, connection, extra_headers )
+                raise
+            except socket.error as e:
+                connection.close()
+                if attempt or not reused or e.errno not in ( errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE ):
+                    raise
+            except httplib.BadStatusLine as e:
+                connection.close()
+                # httplib reports a connection that closed before any of the response arrived with one of these
+                nothing_received = e.line in ( "", "''" ) or e.line.startswith( "No status line received" )
+                if attempt or not reused or not nothing_received:
+                    raise
+            except:
+                connection.close()
+                raise
+            else:
+                self.checkin( host, connection, extra_headers )
+                return result
+
+    def single_request_on( self, connection, extra_headers, host, handler, request_body, verbose=0 ):
+        """Transport.single_request(), on the given connection and with its extra headers rather than the transport's own."""
+        if verbose:
+            connection.set_debuglevel(1)
+        self.send_request( connection, handler, request_body )
+        for key, value in extra_headers or ():
+            connection.putheader( key, value )
+        self.send_user_agent( connection )
+        self.send_content( connection, request_body )
+        response = connection.getresponse( buffering=True )
+        if response.status == 200:
+            self.verbose = verbose
+            return self.parse_response( response )
+        raise xmlrpclib.ProtocolError( host + handler, response.status, response.reason, response.msg )
+
+    def close( self ):
+        with self.lock:
+            for idle in self.idle.values():
+                for connection, extra_headers, last_used in idle:
+                    connection.close()
+            self.idle = {}
+
 ## Functions
+def calls_per_second( make_proxy, method, num_threads, calls_per_thread ):
+    """Calls method calls_per_thread times from each of num_threads threads.
+    make_proxy() is called for every call, so it decides whether a proxy is reused or not."""
+    def caller():
+        for i in xrange( calls_per_thread ):
+            getattr( make_proxy(), method )()
+
+    threads = [ threading.Thread( target=caller ) for i in xrange( num_threads ) ]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return num_threads * calls_per_thread / ( time.time() - start )
 
     
 ## Constants
@@ -61,6 +208,9 @@ chapter_sections = [
     {},
     { 'string':"This is a string with control characters" + '\0'},
     {},
+    {},
+    { 'sizes':[ 1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024 ] },
+    { 'threads':[ 1, 4, 16 ], 'calls':2000 },
 ]
         
 ## Runtime Configuration
@@ -226,8 +376,56 @@ if results.section in xrange( 0, len(chapter_sections)+1 ):
                 logger.info( "%s : %s", i, r )
         except xmlrpclib.Fault, err:
             logger.error( err )
-        
-        
+
+    if results.section == 7 or results.section == 0:
+        logger = logging.getLogger("12.10.7 Framing Binary Data")
+        ## 12.10.7 Framing Binary Data
+        # Binary values are sent as base64 text inside the XML, which makes them a third bigger and is slow to encode and parse when they are large.
+        # FramedTransport asks the server for framed messages instead, with the raw bytes after the XML and a reference to them in its place.
+        # The server in 12.10-xmlrpclib_server.py answers in frames when asked, and in plain XML-RPC to every other client,
+        # and FramedTransport only starts sending frames after the server has answered with one, so either side can be an old one.
+        # The framing itself is defined once, in xmlrpclib_framing.py, for both the client and the server.
+        url = "http://%s:%s" % ( chapter_sections[0]['host'], chapter_sections[0]['port'] )
+        plain = xmlrpclib.ServerProxy( url )
+        transport = FramedTransport()
+        framed = xmlrpclib.ServerProxy( url, transport=transport )
+        framed.ping()
+        logger.info( "Server sends frames: %s", transport.server_frames )
+
+        for size in chapter_sections[7]['sizes']:
+            data = os.urandom( size )
+            for name, proxy, request in (
+                    ( "base64 XML", plain, xmlrpclib.dumps( ( xmlrpclib.Binary(data), ), 'send_back_binary' ) ),
+                    ( "framed", framed, frame_message( xmlrpclib.dumps( ( xmlrpclib.Binary(data), ), 'send_back_binary' ) ) ) ):
+                start = time.time()
+                response = proxy.send_back_binary( xmlrpclib.Binary(data) )
+                elapsed = time.time() - start
+                assert response.data == data
+                logger.info( "%-10s %9d bytes: request %9d bytes, %7.3fs, %7.1f MB/s",
+                             name, size, len(request), elapsed, 2 * size / elapsed / 1024 / 1024 )
+
+    if results.section == 8 or results.section == 0:
+        logger = logging.getLogger("12.10.8 Pooling Connections")
+        ## 12.10.8 Pooling Connections
+        # A new ServerProxy opens a new TCP connection for its first call, so code that makes a proxy per call pays for a connection every time.
+        # PooledTransport keeps connections open between calls (the server speaks HTTP/1.1 so it doesn't close them),
+        # and one transport can be shared by any number of proxies and threads.
+        url = "http://%s:%s" % ( chapter_sections[0]['host'], chapter_sections[0]['port'] )
+        calls = chapter_sections[8]['calls']
+        for num_threads in chapter_sections[8]['threads']:
+            pooled = PooledTransport( pool_size=num_threads )
+            pooled_gzip = PooledTransport( pool_size=num_threads, gzip=True )
+            for method in ( 'ping', 'now' ):
+                for name, make_proxy in (
+                        ( "proxy per call", lambda: xmlrpclib.ServerProxy( url ) ),
+                        ( "pooled", lambda: xmlrpclib.ServerProxy( url, transport=pooled ) ),
+                        ( "pooled, gzip", lambda: xmlrpclib.ServerProxy( url, transport=pooled_gzip ) ) ):
+                    rate = calls_per_second( make_proxy, method, num_threads, calls // num_threads )
+                    logger.info( "%2d threads %-5s %-15s: %7.1f calls/sec", num_threads, method + "()", name, rate )
+            logger.info( "%2d threads: the pools opened %d and %d connections", num_threads, pooled.connections_opened, pooled_gzip.connections_opened )
+            pooled.close()
+            pooled_gzip.close()
+
 else:
     # If the command isn't recognized because it wasn't given, show the help.
     if not results.section:
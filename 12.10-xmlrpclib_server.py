@@ -1,8 +1,68 @@
-from SimpleXMLRPCServer import SimpleXMLRPCServer
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
 from xmlrpclib import Binary
+import xmlrpclib
 import datetime
+import sys
+import SocketServer
+# the framing protocol, shared with the client in 12.10-xmlrpclib.py
+from xmlrpclib_framing import FRAMED_CONTENT_TYPE, dumps_framed, loads_framed
 
-server = SimpleXMLRPCServer(( 'localhost', 9000), logRequests=True, allow_none=True)
+class FramedXMLRPCRequestHandler( SimpleXMLRPCRequestHandler ):
+    """Answers with a framed message when the client asks for one, otherwise behaves as SimpleXMLRPCRequestHandler.
+    Speaks HTTP/1.1, so clients can keep their connection open between calls."""
+    protocol_version = "HTTP/1.1"
+
+    def do_POST( self ):
+        framed_request = self.headers.get( "content-type" ) == FRAMED_CONTENT_TYPE
+        if not framed_request and FRAMED_CONTENT_TYPE not in self.headers.get( "accept", "" ):
+            return SimpleXMLRPCRequestHandler.do_POST( self )
+        if not self.is_rpc_path_valid():
+            self.report_404()
+            return
+
+        try:
+            size_remaining = int( self.headers["content-length"] )
+            chunks = []
+            while size_remaining:
+                chunk = self.rfile.read( min( size_remaining, 10*1024*1024 ) )
+                if not chunk:
+                    break
+                chunks.append( chunk )
+                size_remaining -= len(chunk)
+            # a gzip Content-Encoding is undone here, as for plain requests
+            data = self.decode_request_content( "".join(chunks) )
+            if data is None:
+                return # the error response has been sent
+            params, method = loads_framed( data )
+            # the same error handling as SimpleXMLRPCDispatcher._marshaled_dispatch()
+            try:
+                response = dumps_framed( ( self.server._dispatch( method, params ), ), methodresponse=1, allow_none=self.server.allow_none )
+            except xmlrpclib.Fault, fault:
+                response = dumps_framed( fault, allow_none=self.server.allow_none )
+            except:
+                exc_type, exc_value, exc_tb = sys.exc_info()
+                response = dumps_framed( xmlrpclib.Fault( 1, "%s:%s" % ( exc_type, exc_value ) ), allow_none=self.server.allow_none )
+        except Exception:
+            self.send_response(500)
+            self.send_header( "Content-length", "0" )
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header( "Content-type", FRAMED_CONTENT_TYPE )
+            # compressed on the same terms as SimpleXMLRPCRequestHandler.do_POST() compresses plain responses
+            if self.encode_threshold is not None and len(response) > self.encode_threshold and self.accept_encodings().get( "gzip", 0 ):
+                response = xmlrpclib.gzip_encode( response )
+                self.send_header( "Content-Encoding", "gzip" )
+            self.send_header( "Content-length", str(len(response)) )
+            self.end_headers()
+            self.wfile.write( response )
+
+class ThreadedXMLRPCServer( SocketServer.ThreadingMixIn, SimpleXMLRPCServer ):
+    """A thread per connection, so one client holding its connection open doesn't lock out the others."""
+    daemon_threads = True
+
+# Clients that don't ask for frames get plain XML-RPC, as before
+server = ThreadedXMLRPCServer(( 'localhost', 9000), requestHandler=FramedXMLRPCRequestHandler, logRequests=True, allow_none=True)
 server.register_introspection_functions()
 server.register_multicall_functions()
 
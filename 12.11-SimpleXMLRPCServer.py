@@ -2,9 +2,15 @@
 ## 12.11 SimpleXMLRPCServer - An XML-RPC Server
 # The SimpleXMLRPCServer module contains classes for creating cross-platform, language-independent servers using the XML-RPC protocol
 # Client libraries exist for many other languages besides Python, making XML-RPC an easy choice for building RPC-style services.
-from SimpleXMLRPCServer import SimpleXMLRPCServer, list_public_methods
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCDispatcher, list_public_methods
+from multiprocessing.pool import ThreadPool
 import os
 import inspect
+import threading
+import time
+import sys
+import xmlrpclib
+from asyncore_http_server import EventLoopServer, error_response
 
 # Set up logging
 import logging
@@ -33,6 +39,43 @@ def expose(f):
 def is_exposed(f):
     """Test whether another function should be publicly exposed."""
     return getattr(f, 'exposed', False)
+
+def serve_in_thread( server ):
+    """Run a server's serve_forever() in a daemon thread, so the caller can go on to be its client."""
+    t = threading.Thread( target=server.serve_forever, name=server.__class__.__name__ )
+    t.setDaemon(True)
+    t.start()
+    return t
+
+def load_test( url, num_clients, calls_per_client, method, *args ):
+    """Call method from num_clients threads at once, each with its own ServerProxy.
+    Returns the requests per second, the median and 99th percentile latency in seconds (None if every call failed),
+    and the number of calls that failed."""
+    latencies = []
+    errors = []
+    def client():
+        proxy = xmlrpclib.ServerProxy( url )
+        func = getattr( proxy, method )
+        for i in xrange( calls_per_client ):
+            start = time.time()
+            try:
+                func( *args )
+            except Exception, e:
+                errors.append( e )
+                continue
+            latencies.append( time.time() - start )
+
+    clients = [ threading.Thread( target=client ) for i in xrange( num_clients ) ]
+    start = time.time()
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    elapsed = time.time() - start
+    latencies.sort()
+    if not latencies:
+        return ( 0.0, None, None, len(errors) )
+    return ( len(latencies) / elapsed, latencies[ len(latencies) // 2 ], latencies[ int( len(latencies) * 0.99 ) ], len(errors) )
     
 ## Classes
 
@@ -56,6 +99,102 @@ class DirectoryService( object ):
         f = getattr(self, method)
         return inspect.getdoc(f)
 
+class CachedDirectoryService( DirectoryService ):
+    """DirectoryService that only works out its method list and docstrings once, rather than on every introspection call.
+    Setting or deleting an attribute on the service clears the cache, for anything else call _invalidate(), which is kept out of the public methods."""
+    def __init__( self ):
+        self._invalidate()
+
+    def _invalidate( self ):
+        # object.__setattr__ so this doesn't call itself
+        object.__setattr__( self, '_cache', {} )
+
+    def __setattr__( self, name, value ):
+        object.__setattr__( self, name, value )
+        self._invalidate()
+
+    def __delattr__( self, name ):
+        object.__delattr__( self, name )
+        self._invalidate()
+
+    def _listMethods( self ):
+        if '_listMethods' not in self._cache:
+            self._cache['_listMethods'] = DirectoryService._listMethods( self )
+        return self._cache['_listMethods']
+
+    def _methodHelp( self, method ):
+        key = ( '_methodHelp', method )
+        if key not in self._cache:
+            # unknown methods raise AttributeError, and aren't cached
+            self._cache[key] = DirectoryService._methodHelp( self, method )
+        return self._cache[key]
+
+class SlowDirectoryService( DirectoryService ):
+    """DirectoryService on a slow disk, every list() call takes at least delay seconds."""
+    def __init__( self, delay=0.01 ):
+        self.delay = delay
+
+    def list( self, dir_name ):
+        """list(dir_name) => [<flienames>]
+        returns a list containing the contents of the named directory, slowly."""
+        time.sleep( self.delay )
+        return DirectoryService.list( self, dir_name )
+
+class AsyncXMLRPCServer( EventLoopServer, SimpleXMLRPCDispatcher ):
+    """An XML-RPC server with a single event loop for all the connections.
+    Requests are parsed and dispatched by a pool of worker threads, so a slow call only holds up its own client,
+    and HTTP/1.1 connections are kept alive between calls.
+    Functions and instances are registered the same way as with SimpleXMLRPCServer, including _dispatch().
+    The event loop and its connections come from asyncore_http_server, shared with 12.2's EventLoopHTTPServer."""
+    logger = logging.getLogger( "AsyncXMLRPCServer" )
+
+    def __init__( self, addr, num_threads=10, allow_none=False, encoding=None, logRequests=True ):
+        EventLoopServer.__init__( self, addr, num_threads )
+        SimpleXMLRPCDispatcher.__init__( self, allow_none, encoding )
+        self.logRequests = logRequests
+
+    def handle_request( self, channel ):
+        if not channel.request_line.startswith( 'POST ' ):
+            return error_response( 501, "Only POST is supported" ), True
+        response = self._marshaled_dispatch( channel.body )
+        keep_alive = channel.keep_alive
+        headers = [ "HTTP/1.1 200 OK",
+                    "Content-Type: text/xml",
+                    "Content-Length: %d" % len(response),
+                    "Connection: %s" % ( 'keep-alive' if keep_alive else 'close' ),
+                    "", "" ]
+        return '\r\n'.join( headers ) + response, not keep_alive
+
+class ParallelMulticallMixIn:
+    """Mix-in for SimpleXMLRPCServer or AsyncXMLRPCServer that runs the calls in a system.multicall batch on a pool of threads,
+    rather than one after the other.  List it before the server class and call register_multicall_functions() as usual.
+    The results come back in the same order as the calls, with a fault in place of any call that failed."""
+    multicall_threads = 10
+    multicall_pool = None
+    multicall_lock = threading.Lock()
+
+    def system_multicall( self, call_list ):
+        """system.multicall([{'methodName': 'add', 'params': [2, 2]}, ...]) => [[4], ...]
+
+        Runs a batch of calls sent in one request, side by side."""
+        with self.multicall_lock:
+            if self.multicall_pool is None:
+                self.multicall_pool = ThreadPool( self.multicall_threads )
+        return self.multicall_pool.map( self.multicall_one, call_list )
+
+    def multicall_one( self, call ):
+        # the same results and faults as SimpleXMLRPCDispatcher.system_multicall()
+        try:
+            return [ self._dispatch( call['methodName'], call['params'] ) ]
+        except xmlrpclib.Fault, fault:
+            return { 'faultCode':fault.faultCode, 'faultString':fault.faultString }
+        except:
+            exc_type, exc_value, exc_tb = sys.exc_info()
+            return { 'faultCode':1, 'faultString':"%s:%s" % ( exc_type, exc_value ) }
+
+class MulticallXMLRPCServer( ParallelMulticallMixIn, SimpleXMLRPCServer ):
+    pass
+
 class MyService( object ):
     PREFIX = "prefix"
     
@@ -91,6 +230,9 @@ chapter_sections = [
     {},
     {},
     {},
+    {},
+    {},
+    {},
 ]
         
 ## Runtime Configuration
@@ -229,6 +371,65 @@ if results.section in xrange( 1, len(chapter_sections) ):
         except KeyboardInterrupt:
             logger.info( "Exiting" )
         
+    if results.section == 8:
+        logger = logging.getLogger("12.11.8 Asynchronous Server")
+        ## 12.11.8 Asynchronous Server
+        # SimpleXMLRPCServer handles one request at a time, so one slow os.listdir() stalls every other client.
+        # AsyncXMLRPCServer runs all the connections from a single asyncore event loop, and passes each request
+        # to a pool of worker threads to be parsed and dispatched, so blocking calls only hold up their own client.
+        # Connections are kept alive, so a ServerProxy (which speaks HTTP/1.1) reuses its connection between calls.
+        # Registration works the same way, here with the prefix-enforcing _dispatch() from section 6.
+        server = AsyncXMLRPCServer( ( chapter_sections[0]['host'], chapter_sections[0]['port'] ) )
+        server.register_instance( MyService() )
+
+        try:
+            logger.info( "Use CTRL-C to exit" )
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info( "Exiting" )
+
+    if results.section == 9:
+        logger = logging.getLogger("12.11.9 Load Testing")
+        ## 12.11.9 Load Testing
+        # This one runs its own servers on localhost, so it doesn't need the client.
+        # Both serve a DirectoryService where every list() takes 10ms, and the same number of clients call it at once.
+        simple_server = SimpleXMLRPCServer( ( '127.0.0.1', 0 ), logRequests=False )
+        simple_server.register_instance( SlowDirectoryService() )
+        serve_in_thread( simple_server )
+
+        async_server = AsyncXMLRPCServer( ( '127.0.0.1', 0 ), logRequests=False )
+        async_server.register_instance( SlowDirectoryService() )
+        serve_in_thread( async_server )
+
+        for num_clients in ( 1, 10, 50 ):
+            for name, server in ( ( "SimpleXMLRPCServer", simple_server ), ( "AsyncXMLRPCServer", async_server ) ):
+                url = 'http://%s:%s' % server.server_address
+                rate, p50, p99, errors = load_test( url, num_clients, 500 // num_clients, 'list', '.' )
+                if p50 is None:
+                    logger.error( "%-18s %2d clients: no calls succeeded, %d failed", name, num_clients, errors )
+                    continue
+                logger.info( "%-18s %2d clients: %7.1f requests/sec, p50 %6.1fms, p99 %6.1fms, %d failed",
+                             name, num_clients, rate, p50 * 1000, p99 * 1000, errors )
+
+    if results.section == 10:
+        logger = logging.getLogger("12.11.10 Caching Introspection and Batching Calls")
+        ## 12.11.10 Caching Introspection and Batching Calls
+        # DirectoryService works out its method list and docstrings again for every system.listMethods() and system.methodHelp().
+        # CachedDirectoryService keeps the answers until the service is changed.
+        # register_multicall_functions() adds system.multicall, which lets a client send a whole batch of calls in one request.
+        # The MulticallXMLRPCServer runs the calls in a batch side by side on a pool of threads, instead of one at a time.
+        server = MulticallXMLRPCServer( ( chapter_sections[0]['host'], chapter_sections[0]['port'] ), logRequests=True )
+        server.register_introspection_functions()
+        server.register_multicall_functions()
+        server.register_instance( CachedDirectoryService() )
+
+        # The client times 100 calls made one by one against the same 100 calls in a single batch
+        try:
+            logger.info( "Use CTRL-C to exit" )
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info( "Exiting" )
+
 else:
     # If the command isn't recognized because it wasn't given, show the help.
     if not results.section:
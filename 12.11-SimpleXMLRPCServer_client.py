@@ -1,5 +1,6 @@
 import xmlrpclib
 import logging
+import time
 
 # Setup logging
 logging.basicConfig( level=logging.DEBUG, format="[%(levelname)-5s] %(asctime)s.%(msecs)03d (%(name)s) %(message)s", datefmt='%H:%M:%S', )
@@ -40,7 +41,8 @@ if results.section == 5:
     #logger.info( "Command: %s : %s",  'proxy.list("/srv")',  proxy.list('/srv') )
     logger.info( "Command: %s : %s",  'proxy.dir.list("/srv/samba")',  proxy.dir.list('/srv/samba') )
     
-if results.section == 6:
+if results.section in ( 6, 8 ):
+    # The asynchronous server in section 8 exposes the same MyService
     logger.info( "private(): %s", proxy.prefix.public() )
     try:
         logger.info( "private(): %s", proxy.prefix.private() )
@@ -57,4 +59,28 @@ if results.section == 7:
         logger.info( "=" * 60 )
         logger.info( method_name )
         logger.info( "=" * 60 )
-        logger.info( proxy.system.methodHelp( method_name ) )
\ No newline at end of file
+        logger.info( proxy.system.methodHelp( method_name ) )
+
+if results.section == 10:
+    # Every call made through the proxy is a round trip to the server.
+    # MultiCall collects the calls instead, and sends them all in one system.multicall request.
+    num_calls = 100
+    start = time.time()
+    for i in xrange( num_calls ):
+        proxy.list( '/tmp' )
+    one_by_one = time.time() - start
+
+    multicall = xmlrpclib.MultiCall( proxy )
+    for i in xrange( num_calls ):
+        multicall.list( '/tmp' )
+    start = time.time()
+    batch_results = list( multicall() )
+    batched = time.time() - start
+    logger.info( "%d calls one by one : %6.1fms", num_calls, one_by_one * 1000 )
+    logger.info( "%d calls in a batch : %6.1fms (%.1fx faster)", len( batch_results ), batched * 1000, one_by_one / batched )
+
+    # Introspection answers are cached on the server after the first time
+    start = time.time()
+    for i in xrange( num_calls ):
+        proxy.system.methodHelp( 'list' )
+    logger.info( "%d system.methodHelp() calls : %6.1fms", num_calls, ( time.time() - start ) * 1000 )
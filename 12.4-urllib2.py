@@ -7,7 +7,18 @@ import urllib
 import itertools
 import mimetypes, mimetools
 import os
+import stat
 import tempfile
+import sys
+import mmap
+import time
+import httplib
+import urlparse
+import threading
+import resource
+import multiprocessing
+import subprocess
+import BaseHTTPServer
 
 try:
     from cStringIO import StringIO
@@ -24,6 +35,51 @@ parser = argparse.ArgumentParser( description="Chapter 12 - The Internet - urlli
 parser.add_argument( '--section','-s', action='store', type=int, dest='section', help="Enter the section number to see the results from that section.  i.e for XX.YY.1, enter 1, for XX.YY.10 enter 10.")
 results = parser.parse_args()
 
+## Functions
+def upload( form, url, method ):
+    """Child process for 12.4.8, posts form to url using method and reports the seconds taken and the peak RSS of the process."""
+    start = time.time()
+    try:
+        response = send_form( form, url, method )
+    finally:
+        form.close()
+    return time.time() - start, resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss, response
+
+def send_form( form, url, method ):
+    """Posts form to url with one of the 12.4.8 methods, returning the response."""
+    if method == 'str':
+        # the whole body as one string
+        request = urllib2.Request( url, str(form) )
+        request.add_header( 'Content-type', form.get_content_type() )
+        response = urllib2.urlopen( request ).read()
+    elif method == 'open_body':
+        # urllib2 reads the body a block at a time
+        request = urllib2.Request( url, form.open_body() )
+        request.add_header( 'Content-type', form.get_content_type() )
+        request.add_header( 'Content-length', form.get_content_length() )
+        response = urllib2.urlopen( request ).read()
+    else:
+        # httplib sends each piece straight from the mapped file
+        host, port = urlparse.urlparse( url ).netloc.split( ':' )
+        connection = httplib.HTTPConnection( host, int(port) )
+        connection.putrequest( 'POST', '/' )
+        connection.putheader( 'Content-type', form.get_content_type() )
+        connection.putheader( 'Content-length', form.get_content_length() )
+        connection.endheaders()
+        for piece in form.iter_body():
+            connection.send( piece )
+        response = connection.getresponse().read()
+    return response
+
+def upload_in_process( form, url, method ):
+    """Runs upload() in a child process, so each method's peak RSS is measured on its own."""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process( target=lambda: queue.put( upload( form, url, method ) ) )
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+    
 ## Classes
 
 # for 12.4.6
@@ -44,36 +100,103 @@ class MultiPartForm( object ):
         return
         
     def add_file( self, fieldname, filename, fileHandle, mimetype=None):
-        """Add a file to be uploaded"""
-        body = fileHandle.read()
+        """Add a file to be uploaded.
+        Regular files on disk and mmap objects are left where they are until the body is sent, so they aren't copied into memory,
+        call close() once it has been sent.  Anything else (a StringIO, a pipe, a socket file) is read now."""
         if mimetype is None:
             mimetype = ( mimetypes.guess_type( filename )[0] or 'application/octet-stream' )
-        self.files.append( ( fieldname, filename, mimetype, body) )
+        if isinstance( fileHandle, mmap.mmap ):
+            body, offset, size = fileHandle, 0, len(fileHandle)
+        elif isinstance( fileHandle, file ) and stat.S_ISREG( os.fstat( fileHandle.fileno() ).st_mode ):
+            # the upload starts from the current position, as it would with read(),
+            # and uses its own descriptor so the caller can close theirs
+            body = os.fdopen( os.dup( fileHandle.fileno() ), 'rb' )
+            offset, size = fileHandle.tell(), os.fstat( body.fileno() ).st_size
+        else:
+            body = fileHandle.read()
+            offset, size = 0, len(body)
+        self.files.append( ( fieldname, filename, mimetype, body, offset, size ) )
         return
         
-    def __str__(self):
-        """Return a string representing the form data, including attached files"""
-        # Build a list of lists, each containing "lines" of the request.
-        # Each part is separated by a boundary string.
-        # Once the list is built, return a string where wach line is separated by '\r\n'
-        parts = []
-        part_boundary = '--' + self.boundary
+    def close( self ):
+        """Closes the descriptors add_file() opened for files on disk, the body can't be sent again after this."""
+        for fieldname, filename, content_type, body, offset, size in self.files:
+            if isinstance( body, file ):
+                body.close()
+        
+    def field_part( self, name, value ):
+        return '--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % ( self.boundary, name, value )
         
+    def file_part_header( self, fieldname, filename, content_type ):
+        return '--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\nContent-Type: %s\r\n\r\n' % \
+            ( self.boundary, fieldname, filename, content_type )
+        
+    def iter_body( self, chunk_size=1024*1024 ):
+        """Yield the form data a piece at a time, the part headers as strings and the files in chunk_size pieces.
+        Files are yielded as buffer objects over a mapping of chunk_size bytes of the file, so sending them doesn't copy them,
+        and each mapping is released once the next piece is asked for."""
+        # Each part is separated by a boundary string.
         # Add the form fields
-        parts.extend( 
-            [ part_boundary, 
-                'Content-Disposition: file; name="%s"; fieldname="%s' % ( fieldname, filename),
-                'Content-Type: %s' % content_type,
-                '',
-                body,
-            ] for fieldname, filename, content_type, body in self.files
-        )
+        for name, value in self.form_fields:
+            yield self.field_part( name, value )
+        
+        # Add the files
+        for fieldname, filename, content_type, body, offset, size in self.files:
+            yield self.file_part_header( fieldname, filename, content_type )
+            if isinstance( body, str ):
+                yield body
+            elif isinstance( body, mmap.mmap ):
+                for start in xrange( offset, size, chunk_size ):
+                    yield buffer( body, start, chunk_size )
+            else:
+                for start in xrange( offset, size, chunk_size ):
+                    # mappings have to start on a multiple of the allocation granularity
+                    aligned = start - start % mmap.ALLOCATIONGRANULARITY
+                    length = min( start + chunk_size, size ) - aligned
+                    window = mmap.mmap( body.fileno(), length, access=mmap.ACCESS_READ, offset=aligned )
+                    yield buffer( window, start - aligned )
+            yield '\r\n'
+        
+        # Add closing boundary marker
+        yield '--%s--\r\n' % self.boundary
+        
+    def get_content_length( self ):
+        """The length of the body, worked out from the fields and file sizes without building it."""
+        length = sum( len( self.field_part( name, value ) ) for name, value in self.form_fields )
+        for fieldname, filename, content_type, body, offset, size in self.files:
+            length += len( self.file_part_header( fieldname, filename, content_type ) ) + size - offset + len('\r\n')
+        return length + len( '--%s--\r\n' % self.boundary )
+        
+    def open_body( self ):
+        """Returns the body as a file-like object, which urllib2 reads and sends a block at a time."""
+        return MultiPartBody( self.iter_body() )
+        
+    def __str__(self):
+        """Return a string representing the form data, including attached files"""
+        # This builds the whole body in memory, use iter_body() or open_body() for large files
+        return ''.join( str(piece) for piece in self.iter_body() )
 
-        # Flatten the list and add closing boundary marker, and the return CR+LF separated data
-        flattened = list( itertools.chain( *parts ) )
-        flattened.append('--' + self.boundary + '--')
-        flattened.append('')
-        return '\r\n'.join( flattened )
+# for 12.4.6
+class MultiPartBody( object ):
+    """A file-like object reading from MultiPartForm.iter_body()."""
+    def __init__( self, pieces ):
+        self.pieces = pieces
+        self.current = ''
+        self.offset = 0
+        
+    def read( self, size=-1 ):
+        """Returns up to size bytes of the current piece, or all of it, and '' once the body has all been read."""
+        while self.offset >= len(self.current):
+            try:
+                self.current = next( self.pieces )
+            except StopIteration:
+                return ''
+            self.offset = 0
+        if size < 0:
+            size = len(self.current) - self.offset
+        data = self.current[ self.offset:self.offset + size ]
+        self.offset += len(data)
+        return data
 
 # for 12.4.7
 class NFSFile(file):
@@ -111,6 +234,24 @@ class FauxNFSHandler( urllib2.BaseHandler ):
                     'Content-length' : size,
         }
         return urllib.addinfourl( fp, headers, req.get_full_url() )
+
+# for 12.4.8
+class CountingHandler( BaseHTTPServer.BaseHTTPRequestHandler ):
+    """Reads a POSTed body a block at a time, and answers with its length."""
+    def do_POST( self ):
+        length = int( self.headers['Content-Length'] )
+        remaining = length
+        while remaining:
+            data = self.rfile.read( min( remaining, 1024*1024 ) )
+            if not data:
+                break
+            remaining -= len(data)
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write( "Received %d bytes\n" % ( length - remaining ) )
+        
+    def log_message( self, format, *args ):
+        pass
         
         
 ## Constants
@@ -123,6 +264,8 @@ chapter_sections = [ {},
                      { 'first_name':"Charlie", 'last_name':"and the Chocolate Factory", },
                      {},
                      {},
+                     {},
+                     { 'upload_size':500 * 1024 * 1024, },
 ]
         
 ## Runtime Configuration
@@ -270,6 +413,49 @@ if results.section in xrange( 0, len(chapter_sections)+1 ):
             os.remove( os.path.join( tempdir, 'file.txt' ) )
             os.removedirs( tempdir )
         
+    if results.section == 8 or results.section == 0:
+        logger = logging.getLogger("12.4.8 Streaming Uploads" )
+        ## 12.4.8 Streaming Uploads
+        # str(form) builds the whole request body in memory, so a large upload is copied into memory at least once.
+        # iter_body() yields the body a piece at a time instead, with files sent from an mmap of the file on disk,
+        # and get_content_length() works out the Content-Length from the file sizes so nothing has to be built first.
+        # urllib2 sends request data with a read() method a block at a time, so open_body() wraps iter_body() for it,
+        # and httplib can send the pieces themselves, so the file is never copied by Python at all.
+        # Each method uploads the same 500MB file to a server on localhost, from a separate process so its peak RSS can be measured.
+        server = BaseHTTPServer.HTTPServer( ('127.0.0.1', 0), CountingHandler )
+        server_thread = threading.Thread( target=server.serve_forever )
+        server_thread.setDaemon(True)
+        server_thread.start()
+        url = 'http://%s:%s/' % server.server_address
+        
+        fd, filename = tempfile.mkstemp()
+        try:
+            block = os.urandom( 1024 * 1024 )
+            with os.fdopen( fd, 'wb' ) as f:
+                for i in xrange( chapter_sections[8]['upload_size'] // len(block) ):
+                    f.write( block )
+            
+            for method in ( 'str', 'open_body', 'iter_body' ):
+                form = MultiPartForm()
+                form.add_field( 'name', 'upload test' )
+                with open( filename, 'rb' ) as f:
+                    form.add_file( 'datafile', 'upload.bin', f )
+                elapsed, peak_rss, response = upload_in_process( form, url, method )
+                # the child closed its copy of the descriptor, this closes the one left here
+                form.close()
+                logger.info( "%-9s: %6.1f MB/s, peak RSS %6.1f MB, %s",
+                             method, chapter_sections[8]['upload_size'] / elapsed / 1024 / 1024, peak_rss / 1024.0, response.strip() )
+            
+            # A pipe can't be mapped or seeked, so it's read when it's added, as any other file-like object is
+            form = MultiPartForm()
+            pipe = subprocess.Popen( [ 'echo', 'from a pipe' ], stdout=subprocess.PIPE )
+            form.add_file( 'piped', 'pipe.txt', pipe.stdout )
+            pipe.wait()
+            logger.info( "pipe     : %s", send_form( form, url, 'iter_body' ).strip() )
+        finally:
+            os.remove( filename )
+            server.shutdown()
+        
    
 else:
     # If the command isn't recognized because it wasn't given, show the help.
@@ -2,7 +2,7 @@
  # A Queue is a FIFO data structure suitable for multithreaded programming
  # add elements with put() and retrieve elements with get()
 
-import Queue, threading
+import Queue, threading, collections, time
 
 q = Queue.Queue()
 
@@ -54,3 +54,152 @@ for w in workers:
         w.setDaemon(True)
         w.start()
 q.join()
+
+ # Batched Work Queue
+ # Every put() and get() on the PriorityQueue reorders a heap, calling Job.__cmp__ at each step, and each worker
+ # takes one job per get().  With only a few priority levels a deque per level (a lane) does the same job
+ # without comparing anything, and get_batch() hands a worker up to max_items jobs per trip through the lock.
+ # Jobs put with a key are coalesced: while one with the same key is waiting, duplicates are dropped.
+class WorkQueue(object):
+    def __init__(self, priorities):
+        self.priorities = sorted(priorities)
+        self.lanes = dict( (priority, collections.deque()) for priority in priorities )
+        self.pending = set()
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.all_done = threading.Condition(self.mutex)
+        self.unfinished = 0
+        # statistics
+        self.depth = 0
+        self.max_depth = 0
+        self.coalesced = 0
+        self.dequeued = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def put(self, priority, item, key=None):
+        with self.mutex:
+            # look the lane up first, so a bad priority doesn't leave its key pending with nothing queued
+            try:
+                lane = self.lanes[priority]
+            except KeyError:
+                raise ValueError('unknown priority %r, expected one of %r' % (priority, self.priorities))
+            if key is not None:
+                if key in self.pending:
+                    self.coalesced += 1
+                    return False
+                self.pending.add(key)
+            lane.append( (time.time(), key, item) )
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+            self.unfinished += 1
+            self.not_empty.notify()
+            return True
+
+    def get_batch(self, max_items, max_wait=0):
+        """Waits for at least one job, then up to max_wait seconds more for the batch to fill.
+        Returns up to max_items jobs, most important lane first"""
+        with self.mutex:
+            while not self.depth:
+                self.not_empty.wait()
+            deadline = time.time() + max_wait
+            while self.depth < max_items:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.not_empty.wait(remaining)
+            batch = []
+            now = time.time()
+            for priority in self.priorities:
+                lane = self.lanes[priority]
+                while lane and len(batch) < max_items:
+                    queued_at, key, item = lane.popleft()
+                    if key is not None:
+                        self.pending.discard(key)
+                    latency = now - queued_at
+                    self.total_latency += latency
+                    self.max_latency = max(self.max_latency, latency)
+                    batch.append(item)
+            self.depth -= len(batch)
+            self.dequeued += len(batch)
+            if self.depth:
+                # there's more for the other workers
+                self.not_empty.notify()
+            return batch
+
+    def task_done(self, count=1):
+        """Marks count jobs from get_batch() as finished, raises ValueError if more are marked than were put, as Queue.task_done() does"""
+        with self.mutex:
+            unfinished = self.unfinished - count
+            if unfinished <= 0:
+                if unfinished < 0:
+                    raise ValueError('task_done() called too many times')
+                self.all_done.notify_all()
+            self.unfinished = unfinished
+
+    def join(self):
+        with self.mutex:
+            while self.unfinished:
+                self.all_done.wait()
+
+    def stats(self):
+        with self.mutex:
+            return 'depth %d (max %d), %d coalesced, latency mean %.2fms max %.2fms' % (
+                self.depth, self.max_depth, self.coalesced,
+                self.total_latency / self.dequeued * 1000 if self.dequeued else 0, self.max_latency * 1000 )
+
+def process_batches(q):
+    while True:
+        batch = q.get_batch(10)
+        for description in batch:
+            print 'Processing job:', description
+        q.task_done(len(batch))
+
+q = WorkQueue([1, 3, 10])
+q.put(3, 'Mid-level job')
+q.put(10, 'Low-level job', key='cleanup')
+q.put(10, 'Low-level job, again', key='cleanup')
+q.put(1, 'Important job')
+
+worker = threading.Thread(target=process_batches, args=(q,))
+worker.setDaemon(True)
+worker.start()
+q.join()
+print q.stats()
+print
+
+ # Jobs per second with 2 to 32 workers, PriorityQueue and task_done() against WorkQueue.get_batch()
+class QuietJob(Job):
+    def __init__(self, priority, description):
+        self.priority = priority
+        self.description = description
+
+def drain_queue(q):
+    while True:
+        q.get()
+        q.task_done()
+
+def drain_work_queue(q):
+    while True:
+        q.task_done( len(q.get_batch(32)) )
+
+num_jobs = 20000
+priorities = [1, 3, 10]
+for num_workers in [2, 4, 8, 16, 32]:
+    timings = []
+    for q, target in [ (Queue.PriorityQueue(), drain_queue), (WorkQueue(priorities), drain_work_queue) ]:
+        workers = [ threading.Thread(target=target, args=(q,)) for i in xrange(num_workers) ]
+        for w in workers:
+            w.setDaemon(True)
+            w.start()
+        start = time.time()
+        for i in xrange(num_jobs):
+            priority = priorities[i % len(priorities)]
+            if isinstance(q, WorkQueue):
+                q.put(priority, i)
+            else:
+                q.put(QuietJob(priority, i))
+        q.join()
+        timings.append(time.time() - start)
+    print '%2d workers: PriorityQueue %8.0f jobs/sec, WorkQueue %8.0f jobs/sec' % (
+        num_workers, num_jobs / timings[0], num_jobs / timings[1])
@@ -1,14 +1,14 @@
 ## 7.5 sqlite3 - Embedded Relational Database
 # things I'm familiar with
-import sqlite3, os, sys, csv, itertools
+import sqlite3, os, sys, csv, itertools, operator, tempfile, shutil
 # Things I've used a bit
 import logging, threading, time, random
 # things that are relatively new to me
-import collections 
+import collections, Queue, array, gzip, struct, functools
 # literal_eval evaluates a string value to a Boolean "True" becomes True etc.
 from ast import literal_eval
 # closing closes things that need to be closed, whenever they are supposed to close.
-from contextlib import closing
+from contextlib import closing, contextmanager
 
 try: # cPickle is fast but not always available
     import cPickle as pickle
@@ -124,9 +124,9 @@ def create_new_database( db_filename, schema_filename, add_starter_data=False ):
 # to retrieve values, create a cursor from a database connection.
 # A cursor provides a consistent view of data and is the primary means or transacting with a relational db
 
-def fetch_project_tasks( db_filename, project_name, fetch_type = 'all'):
+def fetch_project_tasks( db_filename, project_name, fetch_type = 'all', pooled=False):
     """Provides a bit of a clunky access to fetch certain specific items from the database"""
-    with closing( sqlite3.connect(db_filename) ) as conn:
+    with connect( db_filename, pooled ) as conn:
         # create cursor
         cursor = conn.cursor()
         # execute query through cursor
@@ -220,10 +220,10 @@ def display_rows_via_objects(db_filename, project_name):
     # Positional arguments are indicated with ?s
     
 # Named Parameters are useful in more complex queries and especially when values are used more than once
-def named_parameters(db_filename, project_name):
+def named_parameters(db_filename, project_name, pooled=False):
     """Simple example showing the use of named parameters in sql queries"""
         # Names parameters are indicated like :param_name
-    with closing( sqlite3.connect(db_filename) ) as conn:
+    with connect( db_filename, pooled ) as conn:
         # Change the row_factory to use sqlite3.Row
         conn.row_factory = sqlite3.Row
         
@@ -248,11 +248,11 @@ def named_parameters(db_filename, project_name):
         print
 
 # query parameters can be used with select, insert, and update statements, as long as a literal value is legal in the context
-def update_task_status(db_filename, id, status):
+def update_task_status(db_filename, id, status, pooled=False):
     """updates the status of the task with the specified id"""
     # run as `python 7.5-sqlite3.py update id status`
    
-    with closing( sqlite3.connect(db_filename) ) as conn:
+    with connect( db_filename, pooled ) as conn:
         cursor = conn.cursor()
         
         cursor.execute("""
@@ -309,19 +309,19 @@ def insert_data_from_csv( db_filename, data_filename, conn=None ):
 
 # conversion for types supported beyond the base three is enabled in the db connection by using the detect_types flag.
 # if the columns were declared using the desired type when the table was defined, PARSE_DECLTYPES will provide them
-def show_column_types(db_filename, project_name, type_detection=None):
+def show_column_types(db_filename, project_name, type_detection=None, pooled=False):
     """Displays column datatypes"""
     if type_detection == False:
         print "Without type detection:"
-        with closing( sqlite3.connect(db_filename) ) as conn:
+        with connect( db_filename, pooled ) as conn:
             show_deadline(conn, project_name)
     
     if type_detection == True:
         print "With type detection:"
-        with closing( sqlite3.connect(
-            db_filename, 
+        with connect(
+            db_filename, pooled,
             detect_types=sqlite3.PARSE_DECLTYPES
-        )) as conn:
+        ) as conn:
             show_deadline(conn, project_name)
             
 def show_deadline(conn, project_name):
@@ -799,6 +799,610 @@ def demo_access_restriction( db_filename, p_name ):
         except sqlite3.DatabaseError, err:
             print "SQLite3 Database Error:", err
         
+## 7.5.18 Connection Pooling
+# every helper above opens a new connection, which means opening the file, reading the schema and setting up a
+# fresh statement cache, and then throws all of that away when its with block ends.
+# A pool keeps a few connections per database file open and lends them to one thread at a time.
+# Each connection also keeps the last cached_statements prepared statements, keyed by the SQL text,
+# so running the same query again on a pooled connection skips parsing it.
+class ConnectionPool(object):
+    """Thread-safe pool of open connections to a single database file"""
+    pools = {}
+    pools_lock = threading.Lock()
+
+    def __init__(self, db_filename, size=5, cached_statements=100, **connect_args):
+        self.db_filename = db_filename
+        self.size = size
+        self.cached_statements = cached_statements
+        self.connect_args = connect_args
+        # the most recently returned connection is handed out first, its pages and statements are the warmest
+        self.idle = Queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+        self.closed = False
+        # set by for_database(), so close() can take the pool out of the registry
+        self.key = None
+
+    @classmethod
+    def for_database(cls, db_filename, **connect_args):
+        """Returns the shared pool for db_filename, creating it the first time it's asked for"""
+        key = ( os.path.abspath(db_filename), tuple(sorted(connect_args.items())) )
+        with cls.pools_lock:
+            if key not in cls.pools:
+                cls.pools[key] = cls( db_filename, **connect_args )
+                cls.pools[key].key = key
+            return cls.pools[key]
+
+    def acquire(self, timeout=None):
+        """Takes an idle connection, opens a new one if the pool isn't full yet, or waits for one to be released"""
+        if self.closed:
+            raise sqlite3.ProgrammingError( "Cannot operate on a closed pool." )
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            pass
+        with self.lock:
+            can_open = self.opened < self.size
+            if can_open:
+                self.opened += 1
+        if can_open:
+            try:
+                # the pool makes sure only one thread at a time uses a connection
+                return sqlite3.connect( self.db_filename, check_same_thread=False,
+                                        cached_statements=self.cached_statements, **self.connect_args )
+            except sqlite3.Error:
+                with self.lock:
+                    self.opened -= 1
+                raise
+        # raises Queue.Empty if the timeout runs out
+        return self.idle.get( timeout=timeout )
+
+    def release(self, conn):
+        """Puts the connection back the way it was opened, without anything the borrower left uncommitted or changed,
+        or closes it if the pool has been closed"""
+        conn.rollback()
+        conn.row_factory = None
+        conn.text_factory = unicode
+        conn.isolation_level = self.connect_args.get( 'isolation_level', '' )
+        # close() sets closed under the same lock, so a connection is either put back before it empties idle or closed here
+        with self.lock:
+            if not self.closed:
+                self.idle.put(conn)
+                return
+            self.opened -= 1
+        conn.close()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Closes the idle connections and removes the pool from the registry, connections still in use are closed when released"""
+        with self.lock:
+            self.closed = True
+        with self.pools_lock:
+            if self.pools.get(self.key) is self:
+                del self.pools[self.key]
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except Queue.Empty:
+                break
+            conn.close()
+            with self.lock:
+                self.opened -= 1
+
+def connect( db_filename, pooled=False, **connect_args ):
+    """Returns a context manager for a connection, either freshly opened or borrowed from the pool for db_filename"""
+    if pooled:
+        return ConnectionPool.for_database( db_filename, **connect_args ).connection()
+    return closing( sqlite3.connect( db_filename, **connect_args ) )
+
+def benchmark_pool( db_filename, project_name, calls=2000, thread_counts=(1, 4) ):
+    """Compares fetch_project_tasks calls per second with and without the connection pool"""
+    def run_calls( count, pooled ):
+        for i in xrange(count):
+            fetch_project_tasks( db_filename, project_name, 'one', pooled=pooled )
+
+    for num_threads in thread_counts:
+        for pooled in ( False, True ):
+            threads = [ threading.Thread( target=run_calls, args=( calls // num_threads, pooled ) )
+                        for i in xrange(num_threads) ]
+            # fetch_project_tasks prints every row, so hide that while timing
+            stdout, sys.stdout = sys.stdout, open( os.devnull, 'w' )
+            try:
+                start = time.time()
+                [ t.start() for t in threads ]
+                [ t.join() for t in threads ]
+                elapsed = time.time() - start
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+            print "%d thread(s), %-9s %8.0f calls/sec" % ( num_threads, "pooled:" if pooled else "unpooled:", calls / elapsed )
+
+## 7.5.19 Bulk Loading Large Files
+# insert_data_from_csv() runs the whole file through executemany() as one transaction in the default rollback
+# journal, and every index on the table is updated row by row as it goes.
+# For large exports it is much faster to commit in batches, switch the db to WAL with synchronous=NORMAL while
+# loading (so commits don't wait on a full sync), and build the indexes once at the end.
+TASK_CSV_COLUMNS = ( 'details', 'priority', 'status', 'deadline', 'project' )
+
+def bulk_insert_data_from_csv( db_filename, data_filename, batch_size=50000, defer_indexes=True, report_every=5 ):
+    """Loads a CSV file into the task table in batches, printing progress every report_every seconds"""
+    SQL = """
+    insert into task (details, priority, status, deadline, project)
+    values (?, ?, ?, ?, ?)
+    """
+    with closing( sqlite3.connect( db_filename ) ) as conn:
+        journal_mode = conn.execute( "pragma journal_mode" ).fetchone()[0]
+        synchronous = conn.execute( "pragma synchronous" ).fetchone()[0]
+        conn.execute( "pragma journal_mode = wal" )
+        conn.execute( "pragma synchronous = normal" )
+        # these two only last as long as this connection: a bigger page cache, and sort the index builds in memory
+        conn.execute( "pragma cache_size = -262144" )
+        conn.execute( "pragma temp_store = memory" )
+
+        indexes = []
+        if defer_indexes:
+            indexes = conn.execute( """
+            select name, sql from sqlite_master
+            where type = 'index' and tbl_name = 'task' and sql is not null
+            """ ).fetchall()
+            for name, sql in indexes:
+                conn.execute( 'drop index "%s"' % name )
+            conn.commit()
+
+        total = 0
+        start = last_report = time.time()
+        try:
+            with closing( open( data_filename, 'rb' ) ) as csv_file:
+                # a plain reader and itemgetter are cheaper than building a dict for every row
+                csv_reader = csv.reader(csv_file)
+                header = csv_reader.next()
+                get_columns = operator.itemgetter( *[ header.index(column) for column in TASK_CSV_COLUMNS ] )
+                rows = itertools.imap( get_columns, csv_reader )
+                while True:
+                    batch = list( itertools.islice( rows, batch_size ) )
+                    if not batch:
+                        break
+                    conn.executemany( SQL, batch )
+                    conn.commit()
+                    total += len(batch)
+                    now = time.time()
+                    if now - last_report >= report_every:
+                        print "  %d rows, %.0f rows/sec" % ( total, total / (now - start) )
+                        last_report = now
+        finally:
+            if indexes:
+                print "  Rebuilding %d index(es)" % len(indexes)
+            for name, sql in indexes:
+                conn.execute(sql)
+            conn.commit()
+            conn.execute( "pragma synchronous = %d" % synchronous )
+            conn.execute( "pragma journal_mode = %s" % journal_mode )
+
+    elapsed = time.time() - start
+    print "Loaded %d rows in %.2fs (%.0f rows/sec)" % ( total, elapsed, total / elapsed )
+    return total
+
+def benchmark_bulk_load( schema_filename, data_filename, num_rows=500000 ):
+    """Scales the CSV file up to num_rows rows and times insert_data_from_csv() against bulk_insert_data_from_csv()"""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        scaled_filename = os.path.join( temp_dir, 'tasks.csv' )
+        with closing( open( data_filename, 'rb' ) ) as csv_file:
+            csv_reader = csv.reader(csv_file)
+            header = csv_reader.next()
+            sample = list(csv_reader)
+        with closing( open( scaled_filename, 'wb' ) ) as csv_file:
+            csv_writer = csv.writer(csv_file)
+            csv_writer.writerow(header)
+            csv_writer.writerows( itertools.islice( itertools.cycle(sample), num_rows ) )
+        with closing( open( schema_filename, 'r' ) ) as f:
+            schema = f.read()
+
+        for name, loader in ( ('executemany', insert_data_from_csv), ('bulk', bulk_insert_data_from_csv) ):
+            db_filename = os.path.join( temp_dir, '%s.db' % name )
+            with closing( sqlite3.connect( db_filename ) ) as conn:
+                conn.executescript(schema)
+                conn.execute( "create index task_project_deadline on task (project, deadline)" )
+            start = time.time()
+            loader( db_filename, scaled_filename )
+            elapsed = time.time() - start
+            print "%-12s %d rows in %6.2fs, %8.0f rows/sec\n" % ( name, num_rows, elapsed, num_rows / elapsed )
+    finally:
+        shutil.rmtree(temp_dir)
+
+## 7.5.20 Concurrent Readers and a Single Writer
+# In the default rollback journal a writer locks out every reader while it commits, and demo_threading() shows
+# that a single connection can't be shared between threads anyway.
+# In WAL mode readers see the last committed snapshot and never wait on the writer, so each reader thread can
+# have its own (read-only) connection.  Writes are funnelled through one thread that owns the only write
+# connection, and whatever has queued up while it was busy goes into the same transaction (group commit).
+class WriterThread(threading.Thread):
+    """Owns the only write connection to the db, applying queued statements and committing them in groups.
+    A statement that fails is left out of its group and passed to on_error(sql, parameters, error),
+    which by default keeps it in errors.  A group whose commit fails is rolled back and reported the same way,
+    with each of its statements.  Either way the thread carries on with the next group."""
+    def __init__(self, db_filename, max_batch=500, queue_size=10000, on_error=None):
+        threading.Thread.__init__(self, name='Writer')
+        self.daemon = True
+        self.db_filename = db_filename
+        self.max_batch = max_batch
+        self.queue = Queue.Queue(queue_size)
+        self.statements = 0
+        self.commits = 0
+        self.errors = []
+        self.on_error = on_error or ( lambda sql, parameters, error: self.errors.append( (sql, parameters, error) ) )
+
+    def execute(self, sql, parameters=()):
+        """Queues a statement from any thread, it's committed along with whatever else is waiting"""
+        self.queue.put( (sql, parameters) )
+
+    def stop(self):
+        """Commits everything already queued and waits for the thread to finish"""
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        with closing( sqlite3.connect( self.db_filename, timeout=30 ) ) as conn:
+            running = True
+            while running:
+                batch = [ self.queue.get() ]
+                while len(batch) < self.max_batch:
+                    try:
+                        batch.append( self.queue.get_nowait() )
+                    except Queue.Empty:
+                        break
+                applied = []
+                for item in batch:
+                    if item is None:
+                        running = False
+                        break
+                    try:
+                        # sqlite undoes a failed statement by itself, the rest of the transaction stands
+                        conn.execute( *item )
+                    except sqlite3.Error, error:
+                        self.on_error( item[0], item[1], error )
+                    else:
+                        applied.append(item)
+                try:
+                    conn.commit()
+                except sqlite3.Error, error:
+                    conn.rollback()
+                    for sql, parameters in applied:
+                        self.on_error( sql, parameters, error )
+                else:
+                    self.statements += len(applied)
+                    self.commits += 1
+
+def read_only_reader( db_filename, stop, latencies ):
+    """Runs the task listing on its own read-only connection until stop is set, recording how long each took"""
+    with closing( sqlite3.connect( db_filename, timeout=30 ) ) as conn:
+        conn.execute( "pragma query_only = 1" )
+        while not stop.is_set():
+            start = time.time()
+            conn.execute( """  select * from task  """ ).fetchall()
+            latencies.append( time.time() - start )
+
+def percentile( sorted_values, percent ):
+    """Nearest-rank percentile of an already sorted list, None if it's empty"""
+    if not sorted_values:
+        return None
+    index = int( round( percent / 100.0 * (len(sorted_values) - 1) ) )
+    return sorted_values[index]
+
+def demo_wal_concurrency( db_filename, num_readers=4, duration=3 ):
+    """Measures reader latency while a writer streams updates, in the rollback journal and in WAL mode"""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for journal_mode, max_batch in ( ('delete', 1), ('wal', 500) ):
+            # work on a copy, WAL mode is stored in the db file and the updates are just noise
+            copy_filename = os.path.join( temp_dir, 'to-do-%s.db' % journal_mode )
+            shutil.copy( db_filename, copy_filename )
+            with closing( sqlite3.connect( copy_filename ) ) as conn:
+                conn.execute( "pragma journal_mode = %s" % journal_mode )
+                task_ids = [ row[0] for row in conn.execute( "select id from task" ) ]
+
+            writer = WriterThread( copy_filename, max_batch=max_batch )
+            writer.start()
+            stop = threading.Event()
+            latencies = []
+            readers = [ threading.Thread( name='Reader %d' % i, target=read_only_reader,
+                                          args=( copy_filename, stop, latencies ) )
+                        for i in xrange(num_readers) ]
+            [ t.start() for t in readers ]
+
+            end = time.time() + duration
+            while time.time() < end:
+                writer.execute( "update task set priority = priority + ? where id = ?",
+                                ( random.randint(-1, 1), random.choice(task_ids) ) )
+            # a bad statement is reported without stopping the writer
+            writer.execute( "update no_such_table set priority = 0" )
+            stop.set()
+            [ t.join() for t in readers ]
+            writer.stop()
+
+            latencies.sort()
+            if latencies:
+                print "%-6s %d readers: %6d reads, p50 %.2fms  p90 %.2fms  p99 %.2fms  max %.2fms" % (
+                    journal_mode, num_readers, len(latencies),
+                    percentile( latencies, 50 ) * 1000, percentile( latencies, 90 ) * 1000,
+                    percentile( latencies, 99 ) * 1000, latencies[-1] * 1000 )
+            else:
+                # e.g. every reader failed to open the db, their tracebacks are above
+                print "%-6s %d readers: no reads completed" % ( journal_mode, num_readers )
+            print "       writer: %d updates in %d commits" % ( writer.statements, writer.commits )
+            for sql, parameters, error in writer.errors:
+                print "       failed: %s (%s)" % ( sql, error )
+    finally:
+        shutil.rmtree(temp_dir)
+
+## 7.5.21 Batched Aggregation
+# sqlite3 calls step() once for every row, crossing from C into Python each time, and Mode.step() then prints
+# and counts that one value.  The crossing can't be avoided, but it can be made as cheap as possible.
+# BatchAggregate makes step() the append method of a list, so no Python code runs per row at all, and hands the
+# buffered values to process() where sum(), sorted() etc. loop over them in one call (as an array when typecode
+# is set).  NULLs are dropped before process(), as SQL's own aggregates ignore them.  Setting batch_size bounds
+# the buffer, at the price of a Python step() per row to check its length.
+class BatchAggregate(object):
+    """Base class for aggregates that process their values in batches, subclasses define process() and result()"""
+    batch_size = None
+    typecode = None
+
+    # filters out NULLs without calling back into Python for each value
+    not_null = functools.partial(operator.is_not, None)
+
+    def __init__(self):
+        # a list, not an array, since NULLs arrive as None and array.append would raise on them
+        self.buffer = []
+        if self.batch_size is None:
+            # sqlite3 looks step up on the instance, so this replaces the method below
+            self.step = self.buffer.append
+
+    def step(self, value):
+        if value is not None:
+            self.buffer.append(value)
+            if len(self.buffer) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        values = filter(self.not_null, self.buffer)
+        # empty the buffer in place, step may be bound to its append
+        del self.buffer[:]
+        if values:
+            self.process( array.array(self.typecode, values) if self.typecode else values )
+
+    def finalize(self):
+        self.flush()
+        return self.result()
+
+class BatchMode(BatchAggregate):
+    """Mode average, counting each batch by sorting and grouping it"""
+    def __init__(self):
+        super(BatchMode, self).__init__()
+        self.counter = collections.Counter()
+
+    def process(self, values):
+        # sorting and grouping loop in C, leaving one Python step per distinct value instead of one per row
+        for value, group in itertools.groupby( sorted(values) ):
+            self.counter[value] += len( list(group) )
+
+    def result(self):
+        most_common = self.counter.most_common(1)
+        return most_common[0][0] if most_common else None
+
+class BoundedBatchMode(BatchMode):
+    """BatchMode holding at most batch_size values at a time"""
+    batch_size = 10000
+
+class BatchMean(BatchAggregate):
+    """Arithmetic mean of numeric values, processed as an array of doubles"""
+    typecode = 'd'
+
+    def __init__(self):
+        super(BatchMean, self).__init__()
+        self.total = 0.0
+        self.count = 0
+
+    def process(self, values):
+        self.total += sum(values)
+        self.count += len(values)
+
+    def result(self):
+        return self.total / self.count if self.count else None
+
+class QuietMode(Mode):
+    """Mode without the printing, so the benchmark measures the per-row step() and not the console"""
+    def step(self, value):
+        if value is not None:
+            self.counter[value] += 1
+
+    def finalize(self):
+        # no values at all, or only NULLs, gives NULL like the SQL aggregates
+        most_common = self.counter.most_common(1)
+        return most_common[0][0] if most_common else None
+
+def benchmark_aggregates( num_rows=1000000 ):
+    """Times mode(deadline) with the per-row Mode, BatchMode and plain SQL, over the whole table and per project"""
+    with closing( sqlite3.connect( ':memory:' ) ) as conn:
+        conn.execute( "create table task ( id integer primary key, priority integer, deadline date, project text )" )
+        # a skewed distribution, so the mode is well defined
+        conn.executemany( "insert into task (priority, deadline, project) values (?, ?, ?)", (
+            ( random.randint(1, 5), '2013-%02d-%02d' % ( int( random.triangular(1, 12, 6) ), random.randint(1, 28) ),
+              'project-%d' % random.randint(1, 10) )
+            for i in xrange(num_rows) ) )
+        # a row of NULLs, which every aggregate has to skip for its answer to match the SQL one
+        conn.execute( "insert into task (priority, deadline, project) values (null, null, 'project-1')" )
+        conn.commit()
+        conn.create_aggregate( 'mode', 1, QuietMode )
+        conn.create_aggregate( 'batch_mode', 1, BatchMode )
+        conn.create_aggregate( 'bounded_batch_mode', 1, BoundedBatchMode )
+        conn.create_aggregate( 'batch_mean', 1, BatchMean )
+
+        queries = [
+            ( 'per-row step()', "select mode(deadline) from task" ),
+            ( 'batched', "select batch_mode(deadline) from task" ),
+            ( 'batched, 10000 per batch', "select bounded_batch_mode(deadline) from task" ),
+            ( 'SQL group by', "select deadline from task group by deadline order by count(*) desc limit 1" ),
+            ( 'per-row step() by project', "select project, mode(deadline) from task group by project" ),
+            ( 'batched by project', "select project, batch_mode(deadline) from task group by project" ),
+            # the SQL version of a mode per project uses the built in row_number() window function
+            ( 'SQL window by project', """
+                select project, deadline from (
+                    select project, deadline,
+                           row_number() over (partition by project order by count(*) desc) as rank
+                    from task group by project, deadline
+                ) where rank = 1 """ ),
+            ( 'batched mean', "select batch_mean(priority) from task" ),
+            ( 'SQL avg', "select avg(priority) from task" ),
+        ]
+        print "%d rows" % num_rows
+        for name, query in queries:
+            start = time.time()
+            rows = conn.execute(query).fetchall()
+            elapsed = time.time() - start
+            print "%-26s %6.3fs  %s" % ( name, elapsed, rows[0] if len(rows) == 1 else '%d rows' % len(rows) )
+
+        # every aggregate gives NULL when it only sees NULLs
+        print "%-26s %s" % ( 'all NULL', conn.execute(
+            "select mode(deadline), batch_mode(deadline), batch_mean(priority), avg(priority) from task where deadline is null" ).fetchone() )
+
+## 7.5.22 Streaming Backups
+# demo_dump_db_from_memory() prints every statement from iterdump(), which is slow and as big as the SQL text.
+# Python 2's sqlite3 has no Connection.backup(), so backup_database() copies the pages of the db file itself,
+# inside a read transaction so no writer can change them halfway through (rollback journal mode only, a WAL db
+# keeps committed pages in the -wal file, so it is checkpointed first and mustn't be written to meanwhile).
+# Each step of pages_per_step pages is compressed as its own gzip member and appended to the backup, so only one
+# step is ever in memory.  A .progress file records how far it got; if the backup is interrupted, the next run
+# picks up from there, as long as the db's file change counter shows it hasn't been written to since.
+def read_change_counter( db_filename ):
+    """Returns the file change counter from the db header, bumped by every transaction that changes the file"""
+    with closing( open( db_filename, 'rb' ) ) as f:
+        f.seek(24)
+        return struct.unpack( '>I', f.read(4) )[0]
+
+def backup_database( db_filename, backup_filename, pages_per_step=256, compresslevel=6, max_steps=None, report_every=5 ):
+    """Copies db_filename page by page into a gzip file, resuming where an interrupted earlier run stopped.
+    max_steps stops after that many steps, as if interrupted.  Returns True once the backup is complete."""
+    progress_filename = backup_filename + '.progress'
+    with closing( sqlite3.connect( db_filename, isolation_level=None ) ) as conn:
+        if conn.execute( "pragma journal_mode" ).fetchone()[0] == 'wal':
+            conn.execute( "pragma wal_checkpoint(truncate)" )
+        # reading the schema takes the shared lock, which is held until the transaction ends
+        conn.execute( "begin" )
+        conn.execute( "select count(*) from sqlite_master" ).fetchone()
+        page_size = conn.execute( "pragma page_size" ).fetchone()[0]
+        page_count = conn.execute( "pragma page_count" ).fetchone()[0]
+        change_counter = read_change_counter( db_filename )
+
+        pages_done, backup_size = 0, 0
+        if os.path.exists( progress_filename ) and os.path.exists( backup_filename ):
+            with closing( open( progress_filename, 'r' ) ) as f:
+                saved_counter, saved_pages, saved_size = [ int(value) for value in f.read().split() ]
+            if saved_counter == change_counter:
+                pages_done, backup_size = saved_pages, saved_size
+                print "Resuming backup at page %d of %d" % ( pages_done, page_count )
+            else:
+                print "Database changed since the interrupted backup, starting over"
+
+        start = last_report = time.time()
+        steps, start_pages = 0, pages_done
+        with closing( open( db_filename, 'rb' ) ) as db_file:
+            with closing( open( backup_filename, 'ab' ) ) as backup_file:
+                # throw away anything written after the last recorded step, e.g. half a gzip member
+                backup_file.truncate( backup_size )
+                backup_file.seek( backup_size )
+                db_file.seek( pages_done * page_size )
+                while pages_done < page_count:
+                    if max_steps is not None and steps >= max_steps:
+                        break
+                    pages = min( pages_per_step, page_count - pages_done )
+                    member = gzip.GzipFile( fileobj=backup_file, mode='wb', compresslevel=compresslevel )
+                    member.write( db_file.read( pages * page_size ) )
+                    # closing the member writes its trailer, but leaves backup_file open
+                    member.close()
+                    backup_file.flush()
+                    os.fsync( backup_file.fileno() )
+                    pages_done += pages
+                    steps += 1
+                    with closing( open( progress_filename, 'w' ) ) as f:
+                        f.write( "%d %d %d" % ( change_counter, pages_done, backup_file.tell() ) )
+                    now = time.time()
+                    if now - last_report >= report_every:
+                        print "  %d of %d pages, %.0f pages/sec" % ( pages_done, page_count, (pages_done - start_pages) / (now - start) )
+                        last_report = now
+        conn.execute( "commit" )
+
+    elapsed = time.time() - start
+    print "Backed up %d of %d pages of %d bytes in %.2fs, %.0f pages/sec" % (
+        pages_done, page_count, page_size, elapsed, (pages_done - start_pages) / elapsed if elapsed else 0 )
+    if pages_done < page_count:
+        return False
+    os.remove( progress_filename )
+    return True
+
+def restore_database( backup_filename, db_filename, chunk_size=1024*1024 ):
+    """Decompresses a backup made by backup_database() into a new db file, a chunk at a time"""
+    # GzipFile reads the members one after another as if they were a single stream
+    with closing( gzip.open( backup_filename, 'rb' ) ) as backup_file:
+        with closing( open( db_filename, 'wb' ) ) as db_file:
+            shutil.copyfileobj( backup_file, db_file, chunk_size )
+
+def dump_database_compressed( conn, dump_filename, compresslevel=6 ):
+    """Streams iterdump() into a gzip file, for databases such as ':memory:' that have no file to copy"""
+    with closing( gzip.open( dump_filename, 'wb', compresslevel ) ) as dump_file:
+        for statement in conn.iterdump():
+            dump_file.write( '%s\n' % statement.encode('utf-8') )
+
+def restore_dump_compressed( conn, dump_filename ):
+    """Runs the statements in a dump made by dump_database_compressed() against conn, e.g. a new ':memory:' db"""
+    with closing( gzip.open( dump_filename, 'rb' ) ) as dump_file:
+        conn.executescript( dump_file.read().decode('utf-8') )
+
+def demo_backup( db_filename, num_tasks=200000 ):
+    """Backs up a padded copy of db_filename with an interruption in the middle, then restores and checks it.
+    Also dumps the restored db as compressed SQL and checks the dump loads into a :memory: db."""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        copy_filename = os.path.join( temp_dir, 'to-do.db' )
+        backup_filename = os.path.join( temp_dir, 'to-do.db.gz' )
+        restored_filename = os.path.join( temp_dir, 'restored.db' )
+        dump_filename = os.path.join( temp_dir, 'memory.sql.gz' )
+        shutil.copy( db_filename, copy_filename )
+        with closing( sqlite3.connect( copy_filename ) ) as conn:
+            conn.executemany( "insert into task (details, status, deadline, project) values (?, 'new', '2013-10-31', 'pystl')",
+                              ( ( 'Padding task %d' % i, ) for i in xrange(num_tasks) ) )
+            conn.commit()
+        print "Database is %d bytes" % os.path.getsize( copy_filename )
+
+        print "Interrupted backup:"
+        backup_database( copy_filename, backup_filename, max_steps=2 )
+        print "Resumed backup:"
+        backup_database( copy_filename, backup_filename )
+        print "Backup is %d bytes" % os.path.getsize( backup_filename )
+
+        restore_database( backup_filename, restored_filename )
+        with closing( sqlite3.connect( restored_filename ) ) as conn:
+            num_restored = conn.execute( "select count(*) from task" ).fetchone()[0]
+            print "Restored integrity check: %s, %d tasks" % (
+                conn.execute( "pragma integrity_check" ).fetchone()[0], num_restored )
+
+            # the way to back up a :memory: db, which has no file to copy: dump it as SQL and load the dump into a new db
+            start = time.time()
+            dump_database_compressed( conn, dump_filename )
+            print "SQL dump is %d bytes, written in %.2fs" % ( os.path.getsize( dump_filename ), time.time() - start )
+        with closing( sqlite3.connect( ':memory:' ) ) as memory_conn:
+            restore_dump_compressed( memory_conn, dump_filename )
+            num_loaded = memory_conn.execute( "select count(*) from task" ).fetchone()[0]
+            print "Loaded the dump into :memory:, %d tasks, %s" % ( num_loaded, 'matches' if num_loaded == num_restored else 'MISMATCH' )
+    finally:
+        shutil.rmtree(temp_dir)
+
 ## Function Controls
 if __name__ == '__main__':
     # check for special commands as arguments
@@ -894,6 +1498,28 @@ if __name__ == '__main__':
             raise
         insert_data_from_csv( db_filename, csv_file_location )
         
+    elif arg_command == 'bulk_insert':
+        # load a large csv file in batches
+        try:
+            db_filename = sys.argv[2]
+            csv_file_location = sys.argv[3]
+        except IndexError:
+            print "You must specify the database file to use and the csv file of data to insert"
+            raise
+        try:
+            batch_size = int( sys.argv[4] )
+        except IndexError:
+            batch_size = 50000
+        bulk_insert_data_from_csv( db_filename, csv_file_location, batch_size )
+
+    elif arg_command == 'benchmark_bulk':
+        # compare insert_data_from_csv and bulk_insert_data_from_csv on a scaled up copy of the chapters csv
+        try:
+            num_rows = int( sys.argv[2] )
+        except IndexError:
+            num_rows = 500000
+        benchmark_bulk_load( 'data/7.5-sqlite3_to-do_schema.sql', 'data/7.5-sqlite3_chapters.csv', num_rows )
+
     elif arg_command == 'update':
         # update the status of the indicated task
         try:
@@ -970,6 +1596,34 @@ if __name__ == '__main__':
             project_deadline = '2013-10-31'
         demo_dump_db_from_memory( schema_filename, data_filename, project_name, project_description, project_deadline )
         
+    elif arg_command == 'backup':
+        # make or resume a compressed backup of a database file
+        try:
+            db_filename = sys.argv[2]
+            backup_filename = sys.argv[3]
+        except IndexError:
+            print "You must specify the database file and the backup file to write"
+            raise
+        backup_database( db_filename, backup_filename )
+
+    elif arg_command == 'restore':
+        # restore a backup made by the backup command
+        try:
+            backup_filename = sys.argv[2]
+            db_filename = sys.argv[3]
+        except IndexError:
+            print "You must specify the backup file and the database file to restore into"
+            raise
+        restore_database( backup_filename, db_filename )
+
+    elif arg_command == 'demo_backup':
+        # interrupt, resume, restore and check a backup of a copy of the db
+        try:
+            db_filename = sys.argv[2]
+        except IndexError:
+            db_filename = 'data/7.5-sqlite3_to-do.db'
+        demo_backup( db_filename )
+
     elif arg_command == 'demo_functions':
         # show the differences in isolation levels
         try:
@@ -993,6 +1647,14 @@ if __name__ == '__main__':
             project_name = 'pystl'
         mode( db_filename, project_name )
         
+    elif arg_command == 'benchmark_aggregates':
+        # compare the per-row Mode aggregate with the batched one and with plain SQL
+        try:
+            num_rows = int( sys.argv[2] )
+        except IndexError:
+            num_rows = 1000000
+        benchmark_aggregates( num_rows )
+
     elif arg_command == 'custom_sort':
         # sort by custom data object value
         try:
@@ -1009,6 +1671,26 @@ if __name__ == '__main__':
             db_filename = 'data/7.5-sqlite3_to-do.db'
         demo_threading( db_filename )
         
+    elif arg_command == 'benchmark_pool':
+        # compare fetch_project_tasks with and without the connection pool
+        try:
+            db_filename = sys.argv[2]
+        except IndexError:
+            db_filename = 'data/7.5-sqlite3_to-do.db'
+        try:
+            project_name = sys.argv[3]
+        except IndexError:
+            project_name = 'pystl'
+        benchmark_pool( db_filename, project_name )
+
+    elif arg_command == 'demo_wal':
+        # reader latency while a writer streams updates, rollback journal vs WAL with group commit
+        try:
+            db_filename = sys.argv[2]
+        except IndexError:
+            db_filename = 'data/7.5-sqlite3_to-do.db'
+        demo_wal_concurrency( db_filename )
+
     elif arg_command == 'demo_access':
         # Demonstrate how access restrictions can be done via authorization functions
         try:
@@ -1,8 +1,12 @@
 ## 8.1 zlib - GNU zlib Compression
 # the zlib module provides a low-level interface to many of the functions 
 # in the zlib compression library from GNU
-import zlib, binascii, sys
+import zlib, binascii, sys, struct, collections, time, os, tempfile
 import logging, SocketServer, socket, threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+# BlockTransport is shared with 8.3-bz2.py
+from socket_block_transport import BlockTransport
 try:
     from cStringIO import StringIO
 except:
@@ -55,6 +59,86 @@ with open( DATA_FILE, 'r' ) as input:
     remaining = compressor.flush()
     print 'Flushed: %s' % binascii.hexlify(remaining)
 print
+
+# zlib releases the GIL while it compresses, so large blocks can be compressed on several threads at once, the way pigz does it.
+# Each block is compressed as raw deflate data on its own, with the last 32KB of the block before it as its history,
+# and the pieces are joined behind a zlib header and followed by the Adler-32 of all the data to make one ordinary zlib stream.
+# Python 2's zlib has no way to set a preset dictionary, so the history is given to each compressor by compressing it first
+# and throwing that output away; the decompressor already has those bytes in its window from the block before.
+DICTIONARY_SIZE = 32 * 1024
+
+def compress_block( block, history, level, final ):
+    """Compress one block as raw deflate data, ending on a byte boundary unless it is the final block"""
+    compressor = zlib.compressobj( level, zlib.DEFLATED, -zlib.MAX_WBITS )
+    if history:
+        compressor.compress( history )
+        compressor.flush( zlib.Z_SYNC_FLUSH )
+    compressed = compressor.compress( block )
+    return compressed + compressor.flush( zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH )
+
+class ParallelCompressobj( object ):
+    """Works like zlib.compressobj(), but compresses block_size pieces of the input on a pool of threads at once.
+    compress() returns whatever blocks have finished, in order, and flush() waits for the rest."""
+    def __init__( self, level=6, threads=4, block_size=128 * 1024 ):
+        self.level = level
+        self.threads = threads
+        self.block_size = block_size
+        self.pool = ThreadPool( threads )
+        self.pending = collections.deque()
+        self.buffer = []
+        self.buffered = 0
+        self.history = ''
+        self.checksum = zlib.adler32( '' )
+        # the zlib header, which depends on the level
+        self.output = [ zlib.compress( '', level )[:2] ]
+
+    def submit( self, block, final=False ):
+        self.checksum = zlib.adler32( block, self.checksum )
+        self.pending.append( self.pool.apply_async( compress_block, ( block, self.history, self.level, final ) ) )
+        self.history = ( self.history + block )[ -DICTIONARY_SIZE: ]
+        # don't let more than a couple of blocks per thread pile up
+        while len( self.pending ) > 2 * self.threads:
+            self.output.append( self.pending.popleft().get() )
+
+    def collect( self ):
+        while self.pending and self.pending[0].ready():
+            self.output.append( self.pending.popleft().get() )
+        output, self.output = ''.join( self.output ), []
+        return output
+
+    def compress( self, data ):
+        self.buffer.append( data )
+        self.buffered += len( data )
+        if self.buffered >= self.block_size:
+            data = ''.join( self.buffer )
+            end = len( data ) - len( data ) % self.block_size
+            for start in xrange( 0, end, self.block_size ):
+                self.submit( data[ start:start + self.block_size ] )
+            self.buffer = [ data[end:] ]
+            self.buffered = len( data ) - end
+        return self.collect()
+
+    def flush( self ):
+        self.submit( ''.join( self.buffer ), final=True )
+        self.buffer = []
+        while self.pending:
+            self.output.append( self.pending.popleft().get() )
+        self.output.append( struct.pack( '>I', self.checksum & 0xffffffff ) )
+        self.pool.close()
+        return self.collect()
+
+# The file loop above works the same with a ParallelCompressobj, although in 64 byte reads it only has output once a block is full
+compressor = ParallelCompressobj( 1, threads=4, block_size=1024 )
+compressed = []
+with open( DATA_FILE, 'r' ) as input:
+    while True:
+        block = input.read( BLOCK_SIZE )
+        if not block:
+            break
+        compressed.append( compressor.compress( block ) )
+    compressed.append( compressor.flush() )
+print 'Parallel compressed %d bytes, decompresses to the file: %s' % ( len( ''.join( compressed ) ), zlib.decompress( ''.join( compressed ) ) == open( DATA_FILE, 'r' ).read() )
+print
    
 ## 8.1.3 Mixed Content Streams
 # The Decompress class returned by decompressobj() can also be used in situations 
@@ -93,11 +177,19 @@ print
 # This server uses the stream compressor to respond to requests of filenames
 # by writing a compressed version of the file to the socket used to communicate with the client
 # Some chunking has been artificially added
+# The handler and client send and receive through a BlockTransport, which sizes its blocks to the connection
+# rather than using a fixed BLOCK_SIZE, and sends slices of the data without copying them.
 class ZlibRequestHandler( SocketServer.BaseRequestHandler ):
     logger = logging.getLogger('Server')
+    read_size = None # None reads as much as the transport sends in a block
+    transport_options = {}
+    
+    def make_compressor(self):
+        return zlib.compressobj(1)
     
     def handle(self):
-        compressor = zlib.compressobj(1)
+        compressor = self.make_compressor()
+        transport = BlockTransport( self.request, **self.transport_options )
         
         # Find out what file the client wants
         filename = self.request.recv(1024) # check port 1024 for requests
@@ -108,26 +200,33 @@ class ZlibRequestHandler( SocketServer.BaseRequestHandler ):
         # Send chunks of the file as they are compressed
         with open( filename, 'rb' ) as input:
             while True:
-                block = input.read( BLOCK_SIZE )
+                block = input.read( self.read_size or transport.block_size )
                 if not block:
                     break
                 self.logger.debug("RAW '%s'", block)
                 compressed = compressor.compress( block )
                 if compressed:
                     self.logger.debug("SENDING '%s'", binascii.hexlify(compressed) )
-                    self.request.send(compressed)
+                    transport.send(compressed)
                 else:
                     self.logger.debug("BUFFERING")
                 
-        # Send any data being buffered by the compressor
+        # Send any data being buffered by the compressor, the transport splits it into blocks
         remaining = compressor.flush()
-        while remaining:
-            to_send = remaining[:BLOCK_SIZE]
-            remaining = remaining[BLOCK_SIZE:]
-            self.logger.debug("FLUSHING '%s'", binascii.hexlify(to_send))
-            self.request.send(to_send)
+        if remaining:
+            self.logger.debug("FLUSHING '%s'", binascii.hexlify(remaining))
+            transport.send(remaining)
+        self.logger.info("sent '%s' in blocks of %d bytes, rtt %s", filename, transport.block_size, transport.rtt())
         return
 
+# The same handler, compressing with a ParallelCompressobj in larger reads
+class ParallelZlibRequestHandler( ZlibRequestHandler ):
+    read_size = 128 * 1024
+    threads = 4
+    
+    def make_compressor(self):
+        return ParallelCompressobj( 1, threads=self.threads )
+
 
 run_server, run_client = False, False
 try:
@@ -163,22 +262,23 @@ if run_client:
     s.send(requested_file)
     
     # Wait to receive a response
-    buffer = StringIO()
+    output = StringIO()
     decompressor = zlib.decompressobj()
+    transport = BlockTransport( s )
     
     while True:
-        response = s.recv(BLOCK_SIZE)
+        response = transport.recv()
         if not response:
             break
         clientLogger.debug( "READ '%s'", binascii.hexlify(response) )
         
-        # Include any unconsumed data when feeding the decompressor
-        to_decompress = decompressor.unconsumed_tail + response
+        # Any unconsumed data is fed back to the decompressor below
+        to_decompress = response
         while to_decompress:
             decompressed = decompressor.decompress(to_decompress)
             if decompressed:
                 clientLogger.debug("DECOMPRESSED '%s'", decompressed)
-                buffer.write(decompressed)
+                output.write(decompressed)
                 # look for unconsumed data due to buffer overflow
                 to_decompress = decompressor.unconsumed_tail
             else:
@@ -189,14 +289,102 @@ if run_client:
     remainder = decompressor.flush()
     if remainder:
         clientLogger.debug("FLUSHED '%s'", remainder)
-        buffer.write(remainder)
+        output.write(remainder)
     
-    full_response = buffer.getvalue()
+    full_response = output.getvalue()
     clientLogger.debug('response matches file contents: %s', lorem == full_response)
         
     # Clean up
     s.close()
+    server.shutdown()
     server.socket.close()
             
 print
 
+## 8.1.6 Parallel Compression
+# Compressing the same data with a single compressobj() and with ParallelCompressobj on more and more threads.
+# The threads only help when there are as many cores to run them on.
+data = open( 'data/6of12.txt', 'rb' ).read() * 100
+print 'Compressing %.1f MB on %d cores' % ( len(data) / 1024.0 / 1024, multiprocessing.cpu_count() )
+fmt = '%-24s %8s %8s %s'
+print fmt % ( 'compressor', 'MB/s', 'ratio', 'decompresses' )
+for threads in ( 0, 1, 2, 4, 8, 16 ):
+    start = time.time()
+    if threads:
+        name = 'ParallelCompressobj(%d)' % threads
+        compressor = ParallelCompressobj( 1, threads=threads )
+    else:
+        name = 'compressobj()'
+        compressor = zlib.compressobj( 1 )
+    compressed = ''.join( [ compressor.compress( data[ i:i + 1024 * 1024 ] ) for i in xrange( 0, len(data), 1024 * 1024 ) ] ) + compressor.flush()
+    elapsed = time.time() - start
+    print fmt % ( name, '%.1f' % ( len(data) / elapsed / 1024 / 1024 ), '%.3f' % ( float( len(compressed) ) / len(data) ), zlib.decompress( compressed ) == data )
+print
+
+# And through the socket server, with the parallel handler
+logging.getLogger('Server').setLevel( logging.INFO )
+server = SocketServer.TCPServer( ( 'localhost', 0 ), ParallelZlibRequestHandler )
+t = threading.Thread( target=server.serve_forever )
+t.setDaemon(True)
+t.start()
+s = socket.create_connection( server.server_address )
+s.send( 'data/6of12.txt' )
+response = []
+while True:
+    received = s.recv( 64 * 1024 )
+    if not received:
+        break
+    response.append( received )
+s.close()
+server.shutdown()
+print 'ParallelZlibRequestHandler response matches file contents:', zlib.decompress( ''.join( response ) ) == open( 'data/6of12.txt', 'rb' ).read()
+print
+
+## 8.1.7 Adaptive Block Sizes
+# Fetching files of different sizes through the handler with the 64 byte blocks used above, and with blocks sized by the transport.
+# The server logs the block size it ended up with and the round trip time it was based on.
+# BlockTransport takes the delivery rate from the bytes the kernel has seen acknowledged, not from how long sendall() took:
+# sendall() returns as soon as a block is copied into the socket's send buffer, so timing it measures memory copies, not the link.
+class FixedBlockZlibRequestHandler( ZlibRequestHandler ):
+    read_size = BLOCK_SIZE
+    transport_options = { 'min_block': BLOCK_SIZE, 'max_block': BLOCK_SIZE }
+
+def fetch( address, filename, **transport_options ):
+    """Asks the server at address for filename and returns it decompressed"""
+    s = socket.create_connection( address )
+    transport = BlockTransport( s, **transport_options )
+    s.send( filename )
+    decompressor = zlib.decompressobj()
+    output = StringIO()
+    while True:
+        response = transport.recv()
+        if not response:
+            break
+        output.write( decompressor.decompress( response ) )
+    output.write( decompressor.flush() )
+    s.close()
+    return output.getvalue()
+
+logging.getLogger('Server').setLevel( logging.INFO )
+source = open( 'data/6of12.txt', 'rb' ).read() * 40
+fmt = '%-30s %8s %10s %s'
+for size in ( 64 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024 ):
+    fd, filename = tempfile.mkstemp( suffix='.txt' )
+    os.write( fd, source[ :size ] )
+    os.close( fd )
+    print '%.0f KB file' % ( size / 1024.0 )
+    print fmt % ( 'handler', 'MB/s', 'seconds', 'matches' )
+    for handler_class, transport_options in ( ( FixedBlockZlibRequestHandler, FixedBlockZlibRequestHandler.transport_options ),
+                                              ( ZlibRequestHandler, {} ) ):
+        server = SocketServer.TCPServer( ( 'localhost', 0 ), handler_class )
+        t = threading.Thread( target=server.serve_forever )
+        t.setDaemon(True)
+        t.start()
+        start = time.time()
+        response = fetch( server.server_address, filename, **transport_options )
+        elapsed = time.time() - start
+        server.shutdown()
+        server.socket.close()
+        print fmt % ( handler_class.__name__, '%.1f' % ( size / elapsed / 1024 / 1024 ), '%.3f' % elapsed, response == source[ :size ] )
+    os.remove( filename )
+    print
@@ -1,6 +1,7 @@
 ## 8.2 gzip - Read and Write GNU Zip Files
 # the gzip module provides a file-like interface to GNU zip files, uzing zlib to de/compress
 import gzip, os, hashlib, itertools, binascii
+import zlib, struct, collections, bisect, random, tempfile, time
 from contextlib import closing
 try:
     from cStringIO import StringIO
@@ -26,18 +27,20 @@ def get_hash(data):
 data = open( 'data/lorem.txt', 'r').read() * 1024
 cksum = get_hash(data)
 
-fmt = "{:5} {:10} {:35}"
-print fmt.format( "Level", "Size", "Checksum" )
-print fmt.format( "-"*5, "-"*10, "-"*35 )
-print fmt.format( "data", len(data), cksum )
+fmt = "{:5} {:10} {:35} {:>7}"
+print fmt.format( "Level", "Size", "Checksum", "Seconds" )
+print fmt.format( "-"*5, "-"*10, "-"*35, "-"*7 )
+print fmt.format( "data", len(data), cksum, "" )
 
 for i in xrange(1, 10):
     filename = 'data/8.2-gzip_compress-level-%s.gz' % i
+    start = time.time()
     with gzip.open( filename, 'wb', compresslevel=i ) as output:
         output.write(data)
+    elapsed = time.time() - start
     size = os.stat(filename).st_size
     cksum = get_hash( open( filename, 'rb').read() )
-    print fmt.format( i, size, cksum )
+    print fmt.format( i, size, cksum, '%.4f' % elapsed )
 print
 
 # A GzipFile instance includes a writelines() method that can write a sequence of strings
@@ -94,3 +97,296 @@ print
 
 print '     REREAD:', len(reread_data)
 print reread_data
+
+## 8.2.4 Random Access with a Checkpoint Index
+# Seeking in a GzipFile decompresses everything before the new position, and seeking backwards starts again from the beginning.
+# An index of checkpoints, each an offset into the compressed data and the 32KB of output before it (the most deflate can refer back to),
+# lets a reader start decompressing at the checkpoint before the position it wants instead.
+# zlib can normally resume at any deflate block, given the bit offset and window, with inflatePrime() and inflateSetDictionary().
+# Python 2's zlib has neither, so the checkpoints are kept at sync flush points - an empty stored block, 00 00 ff ff,
+# that leaves the stream byte aligned - and the window is primed by decompressing it as a stored block of its own.
+# GzipFile.flush(), pigz and the ParallelCompressobj from 8.1 all leave sync flush points, a file without any gets a single checkpoint.
+WINDOW_SIZE = 32 * 1024
+SYNC_MARKER = '\x00\x00\xff\xff'
+INDEX_HEADER = struct.Struct( '!4sQd8sQQ' ) # magic, compressed size, mtime, gzip trailer, spacing, number of checkpoints
+INDEX_CHECKPOINT = struct.Struct( '!QQQI' ) # offset, compressed offset, line, compressed window length
+INDEX_MAGIC = 'GZX2'
+Checkpoint = collections.namedtuple( 'Checkpoint', 'offset compressed_offset line window' )
+
+def skip_gzip_header( input ):
+    """Reads past the gzip member header at the current position of input"""
+    magic, method, flags = struct.unpack( '<2sBB', input.read(4) )
+    if magic != '\037\213' or method != 8:
+        raise IOError( 'Not a gzipped file' )
+    input.read(6) # modification time, extra flags and OS
+    if flags & gzip.FEXTRA:
+        input.read( struct.unpack( '<H', input.read(2) )[0] )
+    for flag in ( gzip.FNAME, gzip.FCOMMENT ):
+        if flags & flag:
+            while input.read(1) not in ( '\000', '' ):
+                pass
+    if flags & gzip.FHCRC:
+        input.read(2)
+
+def start_member( input ):
+    """Skips the trailer of the member ending at the current position and the header of the next one.
+    Returns a decompressor for the next member, or None at the end of the file."""
+    input.seek( 8, os.SEEK_CUR ) # CRC and size
+    position = input.tell()
+    if not input.read(1):
+        return None
+    input.seek( position )
+    skip_gzip_header( input )
+    return zlib.decompressobj( -zlib.MAX_WBITS )
+
+def restore( input, checkpoint ):
+    """Positions input at checkpoint and returns a decompressor primed with its window"""
+    decompressor = zlib.decompressobj( -zlib.MAX_WBITS )
+    if checkpoint.window:
+        # a stored block that isn't the last one: 3 zero header bits padded to a byte, the length and its complement
+        decompressor.decompress( '\x00' + struct.pack( '<HH', len(checkpoint.window), len(checkpoint.window) ^ 0xffff ) + checkpoint.window )
+    input.seek( checkpoint.compressed_offset )
+    return decompressor
+
+def build_gzip_index( filename, spacing=1024 * 1024, chunk_size=64 * 1024 ):
+    """Decompresses filename once, returning a list of Checkpoints at least spacing bytes of output apart"""
+    checkpoints = []
+    offset, line, window = 0, 0, ''
+    with open( filename, 'rb' ) as input:
+        skip_gzip_header( input )
+        decompressor = zlib.decompressobj( -zlib.MAX_WBITS )
+        checkpoints.append( Checkpoint( 0, input.tell(), 0, '' ) )
+        next_checkpoint = spacing
+        while decompressor:
+            position = input.tell()
+            chunk = input.read( chunk_size )
+            if not chunk:
+                break
+            start = 0
+            while start < len(chunk):
+                # Once a checkpoint is due, feed the decompressor up to the end of the next sync marker
+                end = len(chunk)
+                if offset >= next_checkpoint:
+                    marker = chunk.find( SYNC_MARKER, start )
+                    if marker >= 0:
+                        end = marker + len(SYNC_MARKER)
+                output = decompressor.decompress( chunk[ start:end ] )
+                offset += len(output)
+                line += output.count('\n')
+                window = ( window + output[ -WINDOW_SIZE: ] )[ -WINDOW_SIZE: ]
+                if decompressor.unused_data:
+                    # The member ended, the next one starts with an empty window
+                    input.seek( position + end - len(decompressor.unused_data) )
+                    decompressor = start_member( input )
+                    window = ''
+                    if decompressor and offset >= next_checkpoint:
+                        checkpoints.append( Checkpoint( offset, input.tell(), line, window ) )
+                        next_checkpoint = offset + spacing
+                    break
+                if offset >= next_checkpoint and chunk.endswith( SYNC_MARKER, 0, end ):
+                    checkpoint = Checkpoint( offset, position + end, line, window )
+                    # 00 00 ff ff can also turn up inside compressed data, so check that the checkpoint
+                    # decompresses the next bytes the same way the decompressor that got here does
+                    try:
+                        restored = restore( input, checkpoint )
+                        lookahead = input.read( 4096 )
+                        valid = restored.decompress( lookahead ) == decompressor.copy().decompress( lookahead )
+                    except zlib.error:
+                        valid = False
+                    input.seek( position + len(chunk) )
+                    if valid:
+                        checkpoints.append( checkpoint )
+                        next_checkpoint = offset + spacing
+                start = end
+    return checkpoints
+
+def gzip_file_signature( filename ):
+    """Returns ( size, mtime, trailer ) of a gzip file, which an index saved for it has to match.
+    The trailer is the CRC32 and length of the last member's data, so a file rewritten to the same size within the
+    mtime's resolution, or copied with its mtime kept, is still caught unless its last member is unchanged."""
+    stat = os.stat( filename )
+    with open( filename, 'rb' ) as input:
+        input.seek( max( stat.st_size - 8, 0 ) )
+        trailer = input.read(8)
+    return stat.st_size, stat.st_mtime, trailer
+
+def write_gzip_index( index_filename, filename, spacing, checkpoints ):
+    size, mtime, trailer = gzip_file_signature( filename )
+    with open( index_filename, 'wb' ) as output:
+        output.write( INDEX_HEADER.pack( INDEX_MAGIC, size, mtime, trailer, spacing, len(checkpoints) ) )
+        for checkpoint in checkpoints:
+            window = zlib.compress( checkpoint.window )
+            output.write( INDEX_CHECKPOINT.pack( checkpoint.offset, checkpoint.compressed_offset, checkpoint.line, len(window) ) )
+            output.write( window )
+
+def read_gzip_index( index_filename, filename, spacing ):
+    """Returns the checkpoints saved in index_filename, or None if it is missing or out of date"""
+    try:
+        input = open( index_filename, 'rb' )
+    except IOError:
+        return None
+    with input:
+        header = input.read( INDEX_HEADER.size )
+        if len(header) < INDEX_HEADER.size:
+            return None
+        magic, size, mtime, trailer, saved_spacing, count = INDEX_HEADER.unpack( header )
+        # an index from before the mtime and trailer were saved has the old magic, and is rebuilt
+        if magic != INDEX_MAGIC or ( size, mtime, trailer ) != gzip_file_signature( filename ) or saved_spacing != spacing:
+            return None
+        checkpoints = []
+        for i in xrange(count):
+            offset, compressed_offset, line, window_length = INDEX_CHECKPOINT.unpack( input.read( INDEX_CHECKPOINT.size ) )
+            checkpoints.append( Checkpoint( offset, compressed_offset, line, zlib.decompress( input.read( window_length ) ) ) )
+    return checkpoints
+
+class IndexedGzipFile( object ):
+    """A read-only gzip file that seeks by starting from the nearest checkpoint before the new position.
+    The checkpoints are kept next to the file in filename.idx, and rebuilt when the file changes."""
+    chunk_size = 64 * 1024
+    
+    def __init__( self, filename, spacing=1024 * 1024 ):
+        self.input = open( filename, 'rb' )
+        index_filename = filename + '.idx'
+        self.checkpoints = read_gzip_index( index_filename, filename, spacing )
+        if self.checkpoints is None:
+            self.checkpoints = build_gzip_index( filename, spacing )
+            write_gzip_index( index_filename, filename, spacing, self.checkpoints )
+        self.offsets = [ checkpoint.offset for checkpoint in self.checkpoints ]
+        self.lines = [ checkpoint.line for checkpoint in self.checkpoints ]
+        self.start_at( self.checkpoints[0] )
+    
+    def start_at( self, checkpoint ):
+        self.decompressor = restore( self.input, checkpoint )
+        self.buffer = ''
+        self.buffer_offset = checkpoint.offset
+        self.position = checkpoint.offset
+    
+    def fill( self ):
+        """Decompresses another chunk onto the buffer, returning False at the end of the data"""
+        if self.decompressor is None:
+            return False
+        position = self.input.tell()
+        chunk = self.input.read( self.chunk_size )
+        if not chunk:
+            self.decompressor = None
+            return False
+        output = self.decompressor.decompress( chunk )
+        if self.decompressor.unused_data:
+            self.input.seek( position + len(chunk) - len(self.decompressor.unused_data) )
+            self.decompressor = start_member( self.input )
+        # Drop what has already been read before adding more
+        self.buffer = self.buffer[ self.position - self.buffer_offset: ] + output
+        self.buffer_offset = self.position
+        return True
+    
+    def seek( self, offset ):
+        if not self.buffer_offset <= offset <= self.buffer_offset + len(self.buffer):
+            # Carry on decompressing from here unless the checkpoint before offset is closer
+            checkpoint = self.checkpoints[ bisect.bisect_right( self.offsets, offset ) - 1 ]
+            if not checkpoint.offset <= self.buffer_offset + len(self.buffer) <= offset:
+                self.start_at( checkpoint )
+            while offset > self.buffer_offset + len(self.buffer):
+                self.position = self.buffer_offset + len(self.buffer)
+                if not self.fill():
+                    break
+        self.position = offset
+    
+    def tell( self ):
+        return self.position
+    
+    def read( self, size=-1 ):
+        while ( size < 0 or self.position + size > self.buffer_offset + len(self.buffer) ) and self.fill():
+            pass
+        start = self.position - self.buffer_offset
+        data = self.buffer[ start: ] if size < 0 else self.buffer[ start:start + size ]
+        self.position += len(data)
+        return data
+    
+    def read_lines( self, first, last ):
+        """Returns lines first to last, counting from 0, starting from the checkpoint before first.
+        A checkpoint can fall in the middle of a line, so it has to be one that starts before line first."""
+        checkpoint = self.checkpoints[ max( bisect.bisect_left( self.lines, first ) - 1, 0 ) ]
+        self.start_at( checkpoint )
+        line = checkpoint.line
+        lines = []
+        while line <= last:
+            text = self.readline()
+            if not text:
+                break
+            if line >= first:
+                lines.append( text )
+            line += 1
+        return lines
+    
+    def readline( self ):
+        while self.buffer.find( '\n', self.position - self.buffer_offset ) < 0 and self.fill():
+            pass
+        start = self.position - self.buffer_offset
+        end = self.buffer.find( '\n', start )
+        data = self.buffer[ start:end + 1 ] if end >= 0 else self.buffer[ start: ]
+        self.position += len(data)
+        return data
+    
+    def close( self ):
+        self.input.close()
+
+# Writing a log with a sync flush every 500 lines, about every 50KB, then reading 4KB from random offsets in it
+sentences = [ sentence.strip() for sentence in open( 'data/lorem.txt', 'r' ).read().replace( '\n', ' ' ).split( '. ' ) if sentence.strip() ]
+log_filename = os.path.join( tempfile.gettempdir(), '8.2-gzip_log.txt.gz' )
+log_size, lines = 128 * 1024 * 1024, 0
+with closing( gzip.open( log_filename, 'wb' ) ) as output:
+    written = 0
+    while written < log_size:
+        block = ''.join( [ '%010d %s.\n' % ( line, sentences[ line % len(sentences) ] ) for line in xrange( lines, lines + 500 ) ] )
+        output.write( block )
+        output.flush()
+        written += len(block)
+        lines += 500
+log_size = written
+print '%s: %d lines, %.1f MB compressed to %.1f MB' % ( log_filename, lines, log_size / 1024.0 / 1024, os.stat(log_filename).st_size / 1024.0 / 1024 )
+if os.path.exists( log_filename + '.idx' ):
+    os.remove( log_filename + '.idx' )
+
+start = time.time()
+indexed = IndexedGzipFile( log_filename )
+print 'Built %d checkpoints in %.2f seconds, the index is %d bytes' % ( len(indexed.checkpoints), time.time() - start, os.stat( log_filename + '.idx' ).st_size )
+indexed.close()
+start = time.time()
+indexed = IndexedGzipFile( log_filename )
+print 'Loaded them again in %.3f seconds' % ( time.time() - start )
+
+random.seed(0)
+offsets = [ random.randrange( log_size ) for i in xrange(1000) ]
+fmt = '{:16} {:>6} {:>12} {:>12}'
+print fmt.format( 'reader', 'reads', 'reads/sec', 'ms per read' )
+with closing( gzip.open( log_filename, 'rb' ) ) as input_file:
+    start = time.time()
+    expected = []
+    for offset in offsets[:10]:
+        input_file.seek( offset )
+        expected.append( input_file.read(4096) )
+    elapsed = time.time() - start
+print fmt.format( 'GzipFile', 10, '%.1f' % ( 10 / elapsed ), '%.1f' % ( elapsed / 10 * 1000 ) )
+start = time.time()
+for offset in offsets:
+    indexed.seek( offset )
+    data = indexed.read(4096)
+elapsed = time.time() - start
+print fmt.format( 'IndexedGzipFile', len(offsets), '%.1f' % ( len(offsets) / elapsed ), '%.1f' % ( elapsed / len(offsets) * 1000 ) )
+matches = []
+for offset, data in zip( offsets, expected ):
+    indexed.seek( offset )
+    matches.append( indexed.read(4096) == data )
+print 'Reads match GzipFile:', all(matches)
+
+# Line ranges start from the checkpoint before the first line
+first = lines // 2
+start = time.time()
+selected = indexed.read_lines( first, first + 4 )
+print 'Lines %d to %d in %.1f ms:' % ( first, first + 4, ( time.time() - start ) * 1000 )
+print ''.join( selected ),
+print 'Line numbers match:', [ int( text.split()[0] ) for text in selected ] == range( first, first + 5 )
+indexed.close()
+os.remove( log_filename )
+os.remove( log_filename + '.idx' )
+print
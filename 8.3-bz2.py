@@ -4,9 +4,13 @@
     # "one shot" de/compression functions for operating on a blob of data
     # iterative de/compression functions for working with a stream of data
     # a file-like class that supports reading and writing line an uncompressed file
-import bz2, binascii, os, itertools, sys
+import bz2, binascii, os, itertools, sys, struct, time, tempfile, hashlib
+import zlib, gzip, collections, shelve, glob
+import multiprocessing
 import logging, SocketServer, socket, threading
 from contextlib import closing
+# BlockTransport is shared with 8.1-zlib.py
+from socket_block_transport import BlockTransport
 try:
     from cStringIO import StringIO
 except:
@@ -106,10 +110,12 @@ print "Input contains %d bytes." % len(data)
 
 for i in xrange(1,10):
     filename = 'data/8.3-bzip_compress-level-%s.bz2' % i
+    start = time.time()
     with closing( bz2.BZ2File( filename, 'wb', compresslevel=i) ) as output:
         output.write(data)
+    elapsed = time.time() - start
     size = os.stat(filename).st_size
-    print "For compresslevel %d, the resulting file is %6d bytes" % ( i, size )
+    print "For compresslevel %d, the resulting file is %6d bytes, written in %.3f seconds" % ( i, size, elapsed )
     
 # A BZ2File instance also has a writelines() method for writing sequences of strings
 with closing( bz2.BZ2File( 'data/8.3-bz2_example-lines.bz2', 'wb' ) ) as output:
@@ -138,11 +144,16 @@ print
 ## 8.3.6 Compressing Network Data
 run_server, run_client = False, False
 
+# The handler and client send and receive through a BlockTransport, which sizes its blocks to the connection
+# rather than using a fixed BLOCK_SIZE, and sends slices of the data without copying them.
 class BZ2RequestHandler( SocketServer.BaseRequestHandler ):
     logger = logging.getLogger('Server')
+    read_size = None # None reads as much as the transport sends in a block
+    transport_options = {}
     
     def handle(self):
         compressor = bz2.BZ2Compressor()
+        transport = BlockTransport( self.request, **self.transport_options )
         
         # Find out what the client wants
         filename = self.request.recv(1024)
@@ -151,24 +162,23 @@ class BZ2RequestHandler( SocketServer.BaseRequestHandler ):
         # Send chunks of the file as they are compressed
         with open( filename, 'rb') as input:
             while True:
-                block = input.read(BLOCK_SIZE)
+                block = input.read(self.read_size or transport.block_size)
                 if not block:
                     break
                 self.logger.debug("RAW '%s'", block)
                 compressed = compressor.compress(block)
                 if compressed:
                     self.logger.debug("SENDING '%s'", binascii.hexlify(compressed) )
-                    s.request.send(compressed)
+                    transport.send(compressed)
                 else:
                     self.logger.debug("Buffering...")
             
-        # Send any data left in the buffer
+        # Send any data left in the buffer, the transport splits it into blocks
         remaining = compressor.flush()
-        while remaining:
-            to_send = remaining[:BLOCK_SIZE]
-            remaining = remaining[BLOCK_SIZE:]
-            self.logger.debug("FLUSHING '%s'", to_send)
-            self.request.send(to_send)
+        if remaining:
+            self.logger.debug("FLUSHING '%s'", binascii.hexlify(remaining))
+            transport.send(remaining)
+        self.logger.info("sent '%s' in blocks of %d bytes, rtt %s", filename, transport.block_size, transport.rtt())
         return
 
 try:
@@ -210,11 +220,12 @@ if run_client:
     s.send(requested_file)
     
     # Wait to receive a response
-    buffer = StringIO()
+    output = StringIO()
     decompressor = bz2.BZ2Decompressor()
+    transport = BlockTransport( s )
     
     while True:
-        response = s.recv(BLOCK_SIZE)
+        response = transport.recv()
         if not response:
             break
         logger.debug( "READ '%s'", binascii.hexlify(response) )
@@ -223,14 +234,351 @@ if run_client:
         decompressed = decompressor.decompress(response)
         if decompressed:
             logger.debug("DECOMPRESSED '%s'", decompressed)
-            buffer.write(decompressed)
+            output.write(decompressed)
         else:
             logger.debug("BUFFERING...")
         
-    full_response = buffer.getvalue()
+    full_response = output.getvalue()
     logger.debug('response matches file contents: %s', lorem == full_response)
         
     # Clean up
     s.close()
     server.shutdown()
     server.socket.close()
+
+## 8.3.7 Adaptive Block Sizes
+# Fetching files of different sizes through the handler with the 64 byte blocks used above, and with blocks sized by the transport.
+# bz2 compresses far slower than the network can carry the result, so the gain is smaller than with zlib.
+# As in 8.1.7 the block size follows the rate the peer acknowledges data at, from TCP_INFO, rather than the time sendall() takes.
+class FixedBlockBZ2RequestHandler( BZ2RequestHandler ):
+    read_size = BLOCK_SIZE
+    transport_options = { 'min_block': BLOCK_SIZE, 'max_block': BLOCK_SIZE }
+
+def fetch( address, filename, **transport_options ):
+    """Asks the server at address for filename and returns it decompressed"""
+    s = socket.create_connection( address )
+    transport = BlockTransport( s, **transport_options )
+    s.send( filename )
+    decompressor = bz2.BZ2Decompressor()
+    output = StringIO()
+    while True:
+        response = transport.recv()
+        if not response:
+            break
+        output.write( decompressor.decompress( response ) )
+    s.close()
+    return output.getvalue()
+
+logging.getLogger('Server').setLevel( logging.INFO )
+source = lorem * 8192
+fmt = '%-30s %8s %10s %s'
+for size in ( 64 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024 ):
+    fd, filename = tempfile.mkstemp( suffix='.txt' )
+    os.write( fd, source[ :size ] )
+    os.close( fd )
+    print '%.0f KB file' % ( size / 1024.0 )
+    print fmt % ( 'handler', 'MB/s', 'seconds', 'matches' )
+    for handler_class, transport_options in ( ( FixedBlockBZ2RequestHandler, FixedBlockBZ2RequestHandler.transport_options ),
+                                              ( BZ2RequestHandler, {} ) ):
+        server = SocketServer.TCPServer( ( 'localhost', 0 ), handler_class )
+        t = threading.Thread( target=server.serve_forever )
+        t.setDaemon(True)
+        t.start()
+        start = time.time()
+        response = fetch( server.server_address, filename, **transport_options )
+        elapsed = time.time() - start
+        server.shutdown()
+        server.socket.close()
+        print fmt % ( handler_class.__name__, '%.1f' % ( size / elapsed / 1024 / 1024 ), '%.3f' % elapsed, response == source[ :size ] )
+    os.remove( filename )
+    print
+
+## 8.3.8 Parallel Compression
+# bzip2 compresses each block of input, up to 100KB * compresslevel, independently, so blocks can be compressed in separate processes.
+# Each process turns its block into a complete stream. Writing those streams one after another would make a multi-stream file,
+# but Python 2's BZ2File stops reading at the end of the first stream. So the blocks are spliced into a single stream instead:
+# blocks aren't byte aligned, and the stream ends with a CRC combined from the CRCs of its blocks.
+# Going the other way, the blocks in a file can be found by their 48 bit magic number and each decompressed as a stream of its own.
+BZ2_BLOCK_SIZE = 899981 # the most input bzip2 puts in one block at compresslevel 9
+BLOCK_MAGIC = 0x314159265359
+STREAM_END_MAGIC = 0x177245385090
+
+def find_magic( data, magic ):
+    """Returns the bit offsets of a 48 bit magic number in data, in order"""
+    offsets = []
+    for shift in xrange(8):
+        # The magic number starting shift bits into a 7 byte window, and the bits of the first and last bytes it covers
+        window = struct.pack( '>Q', magic << ( 8 - shift ) )[1:]
+        head_mask, tail_mask = 0xff >> shift, ( 0xff << ( 8 - shift ) ) & 0xff
+        key = window[ 1 if shift else 0:6 ]
+        found = data.find( key )
+        while found >= 0:
+            i = found - 1 if shift else found
+            if not shift or ( i >= 0 and i + 6 < len(data) and
+                              ord( data[i] ) & head_mask == ord( window[0] ) & head_mask and
+                              ord( data[i + 6] ) & tail_mask == ord( window[6] ) & tail_mask ):
+                offsets.append( i * 8 + shift )
+            found = data.find( key, found + 1 )
+    return sorted( offsets )
+
+def read_bits( data, start, length ):
+    """Returns length bits of data from bit offset start as a number"""
+    if not length:
+        return 0
+    first, last = start // 8, ( start + length + 7 ) // 8
+    value = int( binascii.hexlify( data[ first:last ] ), 16 )
+    return ( value >> ( last * 8 - start - length ) ) & ( ( 1 << length ) - 1 )
+
+def rotate_crc( crc, count ):
+    """Combines stream CRCs the way bzip2 does, rotating left by one bit for every block"""
+    count %= 32
+    return ( ( crc << count ) | ( crc >> ( 32 - count ) ) ) & 0xffffffff
+
+class BitWriter( object ):
+    """Collects values of any number of bits, and hands them back as whole bytes"""
+    def __init__( self ):
+        self.value = 0
+        self.bits = 0
+    
+    def write( self, value, bits ):
+        self.value = ( self.value << bits ) | value
+        self.bits += bits
+    
+    def take( self, pad=False ):
+        """Returns the complete bytes written so far, first filling out the last one with zero bits if pad is true"""
+        if pad and self.bits % 8:
+            self.write( 0, 8 - self.bits % 8 )
+        length, remaining = self.bits // 8, self.bits % 8
+        if not length:
+            return ''
+        data = self.value >> remaining
+        self.value &= ( 1 << remaining ) - 1
+        self.bits = remaining
+        return binascii.unhexlify( '%0*x' % ( length * 2, data ) )
+
+def compress_block( args ):
+    """Compresses block into a stream of its own.
+    Returns the stream, the number of bzip2 blocks in it, the bit offset of its end marker and its combined CRC."""
+    block, level = args
+    compressed = bz2.compress( block, level )
+    end = find_magic( compressed, STREAM_END_MAGIC )[-1]
+    crc = read_bits( compressed, end + 48, 32 )
+    # Make sure the magic numbers found are the blocks, and not the same bits turning up in the compressed data
+    blocks = [ offset for offset in find_magic( compressed, BLOCK_MAGIC ) if offset < end ]
+    combined = 0
+    for offset in blocks:
+        combined = rotate_crc( combined, 1 ) ^ read_bits( compressed, offset + 48, 32 )
+    if combined != crc:
+        raise IOError( 'could not find the blocks in the compressed stream' )
+    return compressed, len(blocks), end, crc
+
+def parallel_compress( blocks, level=9, processes=None ):
+    """Compresses blocks of up to 100KB * level bytes on a pool of processes, yielding the pieces of one bz2 stream"""
+    pool = multiprocessing.Pool( processes )
+    try:
+        yield 'BZh%d' % level
+        writer = BitWriter()
+        combined = 0
+        for compressed, count, end, crc in pool.imap( compress_block, ( ( block, level ) for block in blocks ) ):
+            # Everything between the 4 byte stream header and the end marker is blocks
+            writer.write( read_bits( compressed, 32, end - 32 ), end - 32 )
+            combined = rotate_crc( combined, count ) ^ crc
+            yield writer.take()
+        writer.write( STREAM_END_MAGIC, 48 )
+        writer.write( combined, 32 )
+        yield writer.take( pad=True )
+    finally:
+        pool.terminate()
+
+def find_blocks( data ):
+    """Returns the bit offsets where each bzip2 block in data starts and ends, and its CRC, across all the streams in data"""
+    starts = find_magic( data, BLOCK_MAGIC )
+    markers = sorted( [ ( offset, True ) for offset in starts ] + [ ( offset, False ) for offset in find_magic( data, STREAM_END_MAGIC ) ] )
+    return [ ( start, end, read_bits( data, start + 48, 32 ) ) for ( start, is_block ), ( end, _ ) in zip( markers, markers[1:] ) if is_block ]
+
+def decompress_block( args ):
+    """Decompresses the block between bit offsets start and end of data, by making it a stream of its own"""
+    data, start, end, crc = args
+    writer = BitWriter()
+    writer.write( read_bits( data, start, end - start ), end - start )
+    writer.write( STREAM_END_MAGIC, 48 )
+    writer.write( crc, 32 )
+    return bz2.decompress( 'BZh9' + writer.take( pad=True ) )
+
+def parallel_decompress( data, processes=None ):
+    """Decompresses the bz2 streams in data a block at a time on a pool of processes, yielding the pieces in order.
+    The block magic number could turn up in the compressed data by chance, at about one in 2**48 bit offsets,
+    and the blocks either side of it would then fail to decompress with an IOError."""
+    def pieces():
+        for start, end, crc in find_blocks( data ):
+            first = start // 8
+            yield data[ first:( end + 7 ) // 8 ], start - first * 8, end - first * 8, crc
+    pool = multiprocessing.Pool( processes )
+    try:
+        for output in pool.imap( decompress_block, pieces() ):
+            yield output
+    finally:
+        pool.terminate()
+
+def read_blocks( filename, size=BZ2_BLOCK_SIZE ):
+    with open( filename, 'rb' ) as input:
+        for block in iter( lambda: input.read( size ), '' ):
+            yield block
+
+# lorem.txt repeated to 1GB, compressed and decompressed on one process and on a pool
+workload_size = 1024 * 1024 * 1024
+workload_filename = os.path.join( tempfile.gettempdir(), '8.3-bz2_workload.txt' )
+workload_hash = hashlib.md5()
+with open( workload_filename, 'wb' ) as output:
+    block = lorem * ( 1024 * 1024 // len(lorem) + 1 )
+    for offset in xrange( 0, workload_size, len(block) ):
+        piece = block[ :workload_size - offset ]
+        output.write( piece )
+        workload_hash.update( piece )
+serial_filename, parallel_filename = workload_filename + '.bz2', workload_filename + '.parallel.bz2'
+process_counts = sorted( set( [ 1, multiprocessing.cpu_count() ] ) )
+print 'Compressing %d MB on %d cores' % ( workload_size // 1024 // 1024, multiprocessing.cpu_count() )
+fmt = '{:28} {:>9} {:>8} {:>12}'
+print fmt.format( 'compressor', 'processes', 'MB/s', 'size' )
+
+start = time.time()
+compressor = bz2.BZ2Compressor( 9 )
+with open( serial_filename, 'wb' ) as output:
+    for block in read_blocks( workload_filename, 1024 * 1024 ):
+        output.write( compressor.compress( block ) )
+    output.write( compressor.flush() )
+print fmt.format( 'BZ2Compressor', 1, '%.1f' % ( workload_size / ( time.time() - start ) / 1024 / 1024 ), os.stat( serial_filename ).st_size )
+
+for processes in process_counts:
+    start = time.time()
+    with open( parallel_filename, 'wb' ) as output:
+        for piece in parallel_compress( read_blocks( workload_filename ), processes=processes ):
+            output.write( piece )
+    print fmt.format( 'parallel_compress', processes, '%.1f' % ( workload_size / ( time.time() - start ) / 1024 / 1024 ), os.stat( parallel_filename ).st_size )
+print
+
+print fmt.format( 'decompressor', 'processes', 'MB/s', 'matches' )
+start = time.time()
+output_hash = hashlib.md5()
+with closing( bz2.BZ2File( parallel_filename, 'rb' ) ) as input:
+    for block in iter( lambda: input.read( 1024 * 1024 ), '' ):
+        output_hash.update( block )
+print fmt.format( 'BZ2File', 1, '%.1f' % ( workload_size / ( time.time() - start ) / 1024 / 1024 ), str( output_hash.digest() == workload_hash.digest() ) )
+
+compressed = open( parallel_filename, 'rb' ).read()
+for processes in process_counts:
+    start = time.time()
+    output_hash = hashlib.md5()
+    for piece in parallel_decompress( compressed, processes=processes ):
+        output_hash.update( piece )
+    print fmt.format( 'parallel_decompress', processes, '%.1f' % ( workload_size / ( time.time() - start ) / 1024 / 1024 ), str( output_hash.digest() == workload_hash.digest() ) )
+for filename in ( workload_filename, serial_filename, parallel_filename ):
+    os.remove( filename )
+print
+
+## 8.3.9 Choosing a Codec and Level
+# zlib, gzip and bz2 trade compression ratio against speed differently, and how much depends on the data.
+# benchmark_codecs() measures every codec and level on a sample of the data, and select_codec() picks from the results
+# the best ratio that meets a speed target, for example the most compression at 200 MB/s or more.
+# The results only depend on the kind of data, so they can be kept in a cache, such as a shelf, under a name for it.
+CodecResult = collections.namedtuple( 'CodecResult', 'codec level ratio compress_speed decompress_speed' )
+
+def gzip_compress( data, level ):
+    buffer = StringIO()
+    with closing( gzip.GzipFile( mode='wb', fileobj=buffer, compresslevel=level ) ) as output:
+        output.write( data )
+    return buffer.getvalue()
+
+def gzip_decompress( data ):
+    with closing( gzip.GzipFile( mode='rb', fileobj=StringIO( data ) ) ) as input:
+        return input.read()
+
+# codec: ( compress( data, level ), decompress( data ), levels )
+CODECS = {
+    'zlib': ( zlib.compress, zlib.decompress, range( 1, 10 ) ),
+    'gzip': ( gzip_compress, gzip_decompress, range( 1, 10 ) ),
+    'bz2':  ( bz2.compress, bz2.decompress, range( 1, 10 ) ),
+}
+
+def take_sample( filename, size=1024 * 1024, pieces=16 ):
+    """Returns size bytes of filename, taken as pieces spread evenly through it"""
+    file_size = os.stat( filename ).st_size
+    if file_size <= size:
+        return open( filename, 'rb' ).read()
+    piece_size = size // pieces
+    with open( filename, 'rb' ) as input:
+        sample = []
+        for i in xrange( pieces ):
+            input.seek( ( file_size - piece_size ) * i // ( pieces - 1 ) )
+            sample.append( input.read( piece_size ) )
+    return ''.join( sample )
+
+def measure( function, *args ):
+    """Calls function until at least a tenth of a second has passed, returning its result and the seconds each call took"""
+    calls = 0
+    start = time.time()
+    while True:
+        result = function( *args )
+        calls += 1
+        elapsed = time.time() - start
+        if elapsed >= 0.1:
+            return result, elapsed / calls
+
+def benchmark_codecs( sample, codecs=None ):
+    """Compresses and decompresses sample with each level of each codec, returning a list of CodecResults.
+    codecs maps a name to ( compress( data, level ), decompress( data ), levels ), in the same form as CODECS, which is used by default.
+    Ratios are the size of the sample over the compressed size, speeds are in MB/s of the sample."""
+    if codecs is None:
+        codecs = CODECS
+    megabytes = len(sample) / 1024.0 / 1024
+    results = []
+    for name in sorted( codecs ):
+        compress, decompress, levels = codecs[name]
+        for level in levels:
+            compressed, compress_time = measure( compress, sample, level )
+            decompressed, decompress_time = measure( decompress, compressed )
+            assert decompressed == sample
+            results.append( CodecResult( name, level, float( len(sample) ) / len(compressed), megabytes / compress_time, megabytes / decompress_time ) )
+    return results
+
+def select_codec( sample, min_compress_speed=0, min_decompress_speed=0, cache=None, data_type=None, codecs=None ):
+    """Returns the CodecResult with the best ratio among those that compress and decompress at least as fast as asked, in MB/s,
+    the faster of any with the same ratio. If none are fast enough the one that compresses fastest is returned.
+    codecs is passed on to benchmark_codecs(), to choose among other codecs than CODECS.
+    Given a cache, a dict or a shelf, and a name for the kind of data, the benchmark results are kept in it and reused;
+    they are only valid for the codecs they were measured with, so use a separate cache for each set of codecs."""
+    if cache is not None and data_type in cache:
+        results = cache[data_type]
+    else:
+        results = benchmark_codecs( sample, codecs )
+        if cache is not None:
+            cache[data_type] = results
+    fast_enough = [ result for result in results
+                    if result.compress_speed >= min_compress_speed and result.decompress_speed >= min_decompress_speed ]
+    if not fast_enough:
+        return max( results, key=lambda result: result.compress_speed )
+    return max( fast_enough, key=lambda result: ( result.ratio, result.compress_speed ) )
+
+# The whole matrix for a sample of a text file
+sample = take_sample( 'data/6of12.txt', 256 * 1024 )
+fmt = '{:6} {:>5} {:>8} {:>14} {:>16}'
+print fmt.format( 'codec', 'level', 'ratio', 'compress MB/s', 'decompress MB/s' )
+results = benchmark_codecs( sample )
+for result in results:
+    print fmt.format( result.codec, result.level, '%.2f' % result.ratio, '%.1f' % result.compress_speed, '%.1f' % result.decompress_speed )
+print
+
+# Picking for different targets, with the results for each kind of data kept in a shelf
+cache_filename = os.path.join( tempfile.gettempdir(), '8.3-bz2_codecs.db' )
+with closing( shelve.open( cache_filename, 'n' ) ) as cache:
+    for data_type, filename in ( ( 'text', 'data/6of12.txt' ), ( 'random', None ) ):
+        sample = take_sample( filename, 256 * 1024 ) if filename else os.urandom( 256 * 1024 )
+        for target in ( 0, 20, 200 ):
+            start = time.time()
+            result = select_codec( sample, min_compress_speed=target, cache=cache, data_type=data_type )
+            print 'Best ratio for %-6s data compressing at %3d MB/s or more: %s level %d, ratio %.2f, %.1f MB/s (%.2f seconds)%s' % (
+                data_type, target, result.codec, result.level, result.ratio, result.compress_speed, time.time() - start,
+                '' if result.compress_speed >= target else ', nothing is that fast so this is the fastest' )
+for filename in glob.glob( cache_filename + '*' ):
+    os.remove( filename )
+print
@@ -0,0 +1,208 @@
+import asyncore
+import asynchat
+import socket
+import os
+import threading
+import Queue
+import collections
+import logging
+
+# An HTTP server with one asyncore event loop for all its connections and a pool of worker threads for the requests,
+# shared by EventLoopHTTPServer in 12.2-BaseHTTPServer.py and AsyncXMLRPCServer in 12.11-SimpleXMLRPCServer.py.
+# The loop reads each request in full, a worker turns it into a response, and the loop writes the response back.
+# Subclasses define handle_request().
+
+def error_response( code, message ):
+    """An empty response that closes the connection, for requests that can't be answered."""
+    return "HTTP/1.1 %d %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n" % ( code, message )
+
+class Waker( asyncore.file_dispatcher ):
+    """The read end of a pipe in the event loop.  Writing a byte to it from another thread wakes the loop up."""
+    def __init__( self, callback, map=None ):
+        self.read_fd, self.write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__( self, self.read_fd, map )
+        # file_dispatcher works on a duplicate of the descriptor
+        os.close( self.read_fd )
+        self.callback = callback
+
+    def wake( self ):
+        os.write( self.write_fd, 'x' )
+
+    def writable( self ):
+        return False
+
+    def handle_read( self ):
+        self.recv( 4096 )
+        self.callback()
+
+class HTTPChannel( asynchat.async_chat ):
+    """One client connection to an EventLoopServer.
+    Reads a whole request, headers and body, then hands it to the server's worker threads.
+    Requests with more than the server's max_header_size of headers or max_body_size of body are refused, unread.
+    The connection stays open for the next request unless the response closes it.
+    Pipelined requests, sent before the one ahead of them has been answered, are kept and read once it has."""
+    # send whole responses at once, rather than 4KB at a time
+    ac_out_buffer_size = 64 * 1024
+
+    def __init__( self, server, sock, client_address ):
+        asynchat.async_chat.__init__( self, sock, map=server.socket_map )
+        # responses are written in one go, so there's nothing for Nagle's algorithm to save
+        sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+        self.server = server
+        self.client_address = client_address
+        self.busy = False
+        # bytes received after the request being handled, the start of the next one
+        self.pipelined = ''
+        self.reset()
+
+    def reset( self ):
+        self.incoming = []
+        self.received = 0
+        self.head = None
+        self.request_line = None
+        self.headers = {}
+        self.body = ''
+        self.set_terminator( '\r\n\r\n' )
+
+    def readable( self ):
+        # don't read the next request until this one has been answered
+        return not self.busy and asynchat.async_chat.readable( self )
+
+    def recv( self, buffer_size ):
+        # hand asynchat's handle_read() the pipelined bytes first, rather than reading the socket
+        if self.pipelined:
+            data, self.pipelined = self.pipelined, ''
+            return data
+        return asynchat.async_chat.recv( self, buffer_size )
+
+    def collect_incoming_data( self, data ):
+        if self.busy:
+            # the rest of a refused request, thrown away with the connection
+            return
+        self.received += len(data)
+        if self.head is None and self.received > self.server.max_header_size:
+            self.send_error( 431, "Request Header Fields Too Large" )
+            return
+        self.incoming.append( data )
+
+    def found_terminator( self ):
+        if self.busy:
+            return
+        if self.head is None:
+            # the end of the headers
+            self.head = ''.join( self.incoming ).lstrip( '\r\n' ) + '\r\n\r\n'
+            self.incoming = []
+            lines = self.head.split( '\r\n' )
+            self.request_line = lines[0]
+            for line in lines[1:]:
+                name, _, value = line.partition( ':' )
+                self.headers[ name.strip().lower() ] = value.strip()
+            try:
+                length = int( self.headers.get( 'content-length', 0 ) )
+            except ValueError:
+                self.send_error( 400, "Bad Content-Length" )
+                return
+            if length > self.server.max_body_size:
+                self.send_error( 413, "Request Entity Too Large" )
+                return
+            if length:
+                if self.headers.get( 'expect', '' ).lower() == '100-continue':
+                    self.push( "HTTP/1.1 100 Continue\r\n\r\n" )
+                self.set_terminator( length )
+                return
+        self.body = ''.join( self.incoming )
+        self.incoming = []
+        self.busy = True
+        # set aside anything after this request, which empties the buffer and so ends handle_read()'s loop over it
+        self.pipelined, self.ac_in_buffer = self.ac_in_buffer, ''
+        self.server.submit( self )
+
+    @property
+    def keep_alive( self ):
+        """Whether the client expects the connection to stay open after this request."""
+        version = self.request_line.split()[-1]
+        connection = self.headers.get( 'connection', '' ).lower()
+        if version == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+    def send_response( self, response, close ):
+        """Called in the event loop thread once a worker has the response ready."""
+        self.push( response )
+        if close:
+            self.close_when_done()
+        else:
+            self.busy = False
+            self.reset()
+            if self.pipelined:
+                self.handle_read()
+
+    def send_error( self, code, message ):
+        # stop reading, the rest of the request is thrown away with the connection
+        self.busy = True
+        self.send_response( error_response( code, message ), True )
+
+    def handle_error( self ):
+        self.server.logger.exception( "Error on connection, closing it" )
+        self.close()
+
+class EventLoopServer( asyncore.dispatcher ):
+    """Listens on server_address and runs all of its connections from a single event loop.
+    Complete requests are passed to num_threads worker threads, which call handle_request( channel ) and return
+    ( response, close ), so a slow request only holds up its own client.
+    The threads are started by serve_forever() rather than __init__, so the server can be started in a child process."""
+    logger = logging.getLogger( "EventLoopServer" )
+    channel_class = HTTPChannel
+    max_header_size = 64 * 1024
+    max_body_size = 10 * 1024 * 1024
+    logRequests = False
+
+    def __init__( self, server_address, num_threads=10, request_queue_size=128 ):
+        # a map of its own, so more than one server can run in a process
+        self.socket_map = {}
+        asyncore.dispatcher.__init__( self, map=self.socket_map )
+        self.create_socket( socket.AF_INET, socket.SOCK_STREAM )
+        self.set_reuse_addr()
+        self.bind( server_address )
+        self.listen( request_queue_size )
+        self.server_address = self.socket.getsockname()
+        self.num_threads = num_threads
+        self.tasks = Queue.Queue()
+        self.completed = collections.deque()
+
+    def handle_accept( self ):
+        pair = self.accept()
+        if pair is not None:
+            sock, client_address = pair
+            if self.logRequests:
+                self.logger.info( "Connection from %s:%s", *client_address )
+            self.channel_class( self, sock, client_address )
+
+    def submit( self, channel ):
+        self.tasks.put( channel )
+
+    def worker( self ):
+        while True:
+            channel = self.tasks.get()
+            try:
+                response, close = self.handle_request( channel )
+            except Exception:
+                self.logger.exception( "Error handling request from %s:%s", *channel.client_address )
+                response, close = error_response( 500, "Internal Server Error" ), True
+            self.completed.append( ( channel, response, close ) )
+            self.waker.wake()
+
+    def send_completed( self ):
+        # channels are only touched from the event loop thread
+        while self.completed:
+            channel, response, close = self.completed.popleft()
+            if channel.connected:
+                channel.send_response( response, close )
+
+    def serve_forever( self ):
+        self.waker = Waker( self.send_completed, self.socket_map )
+        for i in xrange( self.num_threads ):
+            t = threading.Thread( target=self.worker, name="%s worker %d" % ( self.__class__.__name__, i ) )
+            t.setDaemon(True)
+            t.start()
+        asyncore.loop( timeout=30, use_poll=True, map=self.socket_map )
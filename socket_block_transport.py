@@ -0,0 +1,81 @@
+import socket
+import struct
+import time
+
+# Offsets into Linux's struct tcp_info: tcpi_rtt (microseconds) follows 8 bytes of flags and 15 other 32 bit fields,
+# and tcpi_bytes_acked (kernel 4.1 and later) follows the rest of the 32 bit fields and two 64 bit pacing rates.
+TCP_INFO_RTT_OFFSET = 68
+TCP_INFO_BYTES_ACKED_OFFSET = 120
+TCP_INFO_SIZE = 128
+
+class BlockTransport( object ):
+    """Sends and receives on a connected socket in blocks sized to the connection, shared by 8.1-zlib.py and 8.3-bz2.py.
+    The block size starts at a quarter of the send buffer, then follows the bandwidth-delay product:
+    the delivery rate times the round trip time, kept between min_block and max_block (the send buffer size).
+    Both come from the kernel's TCP_INFO.  The rate is how fast the peer acknowledged bytes, sampled about once a round trip;
+    timing sendall() instead would only measure how fast data is copied into the send buffer, which says nothing about the link.
+    Where TCP_INFO isn't available (not Linux, or an older kernel) the block size stays where it started.
+    Sends are sendall()s of memoryview slices, and receives go into one preallocated buffer with recv_into().
+    With min_block == max_block the block size is fixed."""
+    def __init__( self, sock, min_block=4096, max_block=None ):
+        self.sock = sock
+        send_buffer = sock.getsockopt( socket.SOL_SOCKET, socket.SO_SNDBUF )
+        receive_buffer = sock.getsockopt( socket.SOL_SOCKET, socket.SO_RCVBUF )
+        self.min_block = min_block
+        self.max_block = max_block or max( send_buffer, min_block )
+        self.block_size = max( self.max_block // 4, self.min_block )
+        self.rate = None
+        self.last_sample = None
+        self.receive_buffer = bytearray( min( max( receive_buffer, self.min_block ), self.max_block ) )
+
+    def tcp_info( self ):
+        """Returns ( round trip time in seconds, total bytes acknowledged by the peer ), or None where TCP_INFO doesn't have them"""
+        try:
+            info = self.sock.getsockopt( socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_SIZE )
+        except ( AttributeError, socket.error ):
+            return None
+        if len(info) < TCP_INFO_SIZE:
+            return None
+        rtt = struct.unpack_from( '=I', info, TCP_INFO_RTT_OFFSET )[0] / 1000000.0
+        acked = struct.unpack_from( '=Q', info, TCP_INFO_BYTES_ACKED_OFFSET )[0]
+        return rtt, acked
+
+    def rtt( self ):
+        """The kernel's smoothed round trip time in seconds, or None where that isn't available"""
+        info = self.tcp_info()
+        return info[0] if info else None
+
+    def adapt( self ):
+        if self.min_block == self.max_block:
+            return
+        info = self.tcp_info()
+        if info is None:
+            return
+        rtt, acked = info
+        now = time.time()
+        if self.last_sample is None:
+            self.last_sample = ( acked, now )
+            return
+        last_acked, last_time = self.last_sample
+        elapsed = now - last_time
+        # acknowledgements arrive once a round trip, so a shorter interval would mostly see nothing
+        if elapsed <= 0 or elapsed < rtt:
+            return
+        rate = ( acked - last_acked ) / elapsed
+        self.rate = rate if self.rate is None else 0.8 * self.rate + 0.2 * rate
+        self.last_sample = ( acked, now )
+        if rtt:
+            self.block_size = int( min( max( self.rate * rtt, self.min_block ), self.max_block ) )
+
+    def send( self, data ):
+        view = memoryview( data )
+        while len(view):
+            block = view[ :self.block_size ]
+            self.sock.sendall( block )
+            self.adapt()
+            view = view[ len(block): ]
+
+    def recv( self ):
+        """Returns the next piece of data as a buffer over the receive buffer, good until the next call, and an empty one at the end"""
+        received = self.sock.recv_into( self.receive_buffer, min( self.block_size, len(self.receive_buffer) ) )
+        return buffer( self.receive_buffer, 0, received )
@@ -0,0 +1,105 @@
+import xmlrpclib
+import binascii
+import struct
+import types
+import re
+
+# Binary framing, shared by 12.10-xmlrpclib.py and 12.10-xmlrpclib_server.py
+# Binary values normally travel as base64 text inside the XML, a third bigger than the data and slow to encode for large blobs.
+# A framed message is the XML document with each Binary replaced by a reference, followed by the raw bytes of the blobs:
+#   FRAME_MAGIC, FRAME_VERSION, length of the XML, number of blobs, the length of each blob, the XML, the blobs
+# Clients ask for framed responses with an Accept header, and only send framed requests to a server that has answered with one,
+# so plain XML-RPC clients and servers never see a frame.  A frame with any other version is refused rather than misread.
+FRAMED_CONTENT_TYPE = "application/x-xmlrpc-framed"
+FRAME_MAGIC = "XRPF"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct( "!4sBII" )
+BLOB_LENGTH = struct.Struct( "!Q" )
+BLOB_REFERENCE = "blob:"
+# a string value can't match this, since its < is escaped, and base64 has no < or : in it
+BASE64_VALUE = re.compile( r"<base64>([^<]*)</base64>" )
+
+class FramedMarshaller( xmlrpclib.Marshaller ):
+    """Marshaller that writes a reference in place of each Binary value, and collects the data in blobs."""
+    dispatch = dict( xmlrpclib.Marshaller.dispatch )
+
+    def __init__( self, encoding=None, allow_none=False ):
+        xmlrpclib.Marshaller.__init__( self, encoding, allow_none )
+        self.blobs = []
+
+    def dump_instance( self, value, write ):
+        if isinstance( value, xmlrpclib.Binary ):
+            write( "<value><base64>%s%d</base64></value>\n" % ( BLOB_REFERENCE, len(self.blobs) ) )
+            self.blobs.append( value.data )
+        else:
+            xmlrpclib.Marshaller.dump_instance( self, value, write )
+    dispatch[types.InstanceType] = dump_instance
+
+class FramedUnmarshaller( xmlrpclib.Unmarshaller ):
+    """Unmarshaller that looks up Binary references in the blobs that came with the XML."""
+    dispatch = dict( xmlrpclib.Unmarshaller.dispatch )
+
+    def __init__( self, blobs, use_datetime=0 ):
+        xmlrpclib.Unmarshaller.__init__( self, use_datetime )
+        self.blobs = blobs
+
+    def end_base64( self, data ):
+        if not data.startswith( BLOB_REFERENCE ):
+            return xmlrpclib.Unmarshaller.end_base64( self, data )
+        value = xmlrpclib.Binary( self.blobs[ int( data[ len(BLOB_REFERENCE): ] ) ] )
+        self.append( value )
+        self._value = 0
+    dispatch["base64"] = end_base64
+
+def pack_frame( xml, blobs ):
+    """Returns the framed message for an XML document and the blobs it refers to."""
+    parts = [ FRAME_HEADER.pack( FRAME_MAGIC, FRAME_VERSION, len(xml), len(blobs) ) ]
+    parts.extend( BLOB_LENGTH.pack( len(blob) ) for blob in blobs )
+    parts.append( xml )
+    parts.extend( blobs )
+    return "".join( parts )
+
+def dumps_framed( params, methodname=None, methodresponse=None, allow_none=False ):
+    """Same as xmlrpclib.dumps(), but returns a framed message."""
+    if isinstance( params, xmlrpclib.Fault ):
+        methodresponse = 1
+    m = FramedMarshaller( "utf-8", allow_none )
+    data = m.dumps( params )
+    if methodname:
+        data = "<?xml version='1.0'?>\n<methodCall>\n<methodName>%s</methodName>\n%s</methodCall>\n" % ( methodname, data )
+    elif methodresponse:
+        data = "<?xml version='1.0'?>\n<methodResponse>\n%s</methodResponse>\n" % data
+    return pack_frame( data, m.blobs )
+
+def frame_message( data ):
+    """Turns a plain XML-RPC message, such as ServerProxy sends, into a framed one by decoding each base64 value into a blob.
+    Only the base64 values are touched, the rest of the XML is copied as it is."""
+    blobs = []
+    def blob_reference( match ):
+        blobs.append( binascii.a2b_base64( match.group(1) ) )
+        return "<base64>%s%d</base64>" % ( BLOB_REFERENCE, len(blobs) - 1 )
+    xml = BASE64_VALUE.sub( blob_reference, data )
+    return pack_frame( xml, blobs )
+
+def loads_framed( data, use_datetime=0 ):
+    """Same as xmlrpclib.loads(), but also accepts framed messages.  Returns ( params, methodname ).
+    Raises ValueError for a frame of a version this module doesn't know."""
+    blobs = []
+    if data.startswith( FRAME_MAGIC ):
+        magic, version, xml_length, num_blobs = FRAME_HEADER.unpack_from( data )
+        if version != FRAME_VERSION:
+            raise ValueError( "Unsupported frame version %d, expected %d" % ( version, FRAME_VERSION ) )
+        offset = FRAME_HEADER.size
+        lengths = [ BLOB_LENGTH.unpack_from( data, offset + i * BLOB_LENGTH.size )[0] for i in xrange( num_blobs ) ]
+        offset += num_blobs * BLOB_LENGTH.size
+        xml = data[ offset:offset + xml_length ]
+        offset += xml_length
+        for length in lengths:
+            blobs.append( data[ offset:offset + length ] )
+            offset += length
+        data = xml
+    u = FramedUnmarshaller( blobs, use_datetime )
+    p = xmlrpclib.ExpatParser( u )
+    p.feed( data )
+    p.close()
+    return u.close(), u.getmethodname()